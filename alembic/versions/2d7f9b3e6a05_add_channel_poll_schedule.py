@@ -0,0 +1,32 @@
+"""Add channel poll schedule
+
+Revision ID: 2d7f9b3e6a05
+Revises: 9a4c2e6f1b38
+Create Date: 2026-10-19 00:41:19.258730
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "2d7f9b3e6a05"
+down_revision = "9a4c2e6f1b38"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("channels", sa.Column("message_rate", sa.Float(), nullable=True))
+    op.add_column("channels", sa.Column("next_poll_utc", sa.TIMESTAMP(), nullable=True))
+
+    # The latest messages of a channel, to measure its activity
+    op.create_index(
+        "ix_messages_channel_id_message_id", "messages", ["channel_id", "message_id"]
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_channel_id_message_id", table_name="messages")
+    op.drop_column("channels", "next_poll_utc")
+    op.drop_column("channels", "message_rate")
@@ -0,0 +1,33 @@
+"""Decode message data
+
+Message data used to be stored as a JSON string holding the JSON of the
+message, instead of the JSON object itself.
+
+Revision ID: 3f9a0c6d58e1
+Revises: e4c07b9a13f2
+Create Date: 2026-10-18 15:27:51.904113
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3f9a0c6d58e1"
+down_revision = "e4c07b9a13f2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    for table in ["messages", "resume_media"]:
+        op.execute(
+            f"UPDATE {table} SET data = (data #>> '{{}}')::jsonb "
+            "WHERE jsonb_typeof(data) = 'string'"
+        )
+
+
+def downgrade() -> None:
+    for table in ["messages", "resume_media"]:
+        op.execute(
+            f"UPDATE {table} SET data = to_jsonb(data::text) "
+            "WHERE jsonb_typeof(data) = 'object'"
+        )
@@ -0,0 +1,33 @@
+"""Add media unique constraint
+
+Revision ID: 5b7e2c91d04a
+Revises: d3e449556763
+Create Date: 2026-10-18 10:12:31.482117
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5b7e2c91d04a"
+down_revision = "d3e449556763"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Keep only the latest row of media that was inserted more than once
+    op.execute(
+        "DELETE FROM media a USING media b "
+        "WHERE a.channel_id = b.channel_id "
+        "AND a.message_id = b.message_id "
+        "AND a.id < b.id"
+    )
+    op.create_unique_constraint(
+        "uq_media_channel_id_message_id",
+        "media",
+        ["channel_id", "message_id"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_constraint("uq_media_channel_id_message_id", "media", type_="unique")
@@ -0,0 +1,35 @@
+"""Add leases
+
+Revision ID: 5e93b7a0d1c4
+Revises: c8f41e7d2a96
+Create Date: 2026-10-18 21:37:48.120563
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5e93b7a0d1c4"
+down_revision = "c8f41e7d2a96"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "leases",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("kind", sa.Text(), nullable=False),
+        sa.Column("key", sa.BigInteger(), nullable=False),
+        sa.Column("owner", sa.Text(), nullable=True),
+        sa.Column("acquired_utc", sa.TIMESTAMP(), nullable=True),
+        sa.Column("expires_utc", sa.TIMESTAMP(), nullable=True),
+        sa.Column("finished_utc", sa.TIMESTAMP(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("kind", "key", name="uq_leases_kind_key"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("leases")
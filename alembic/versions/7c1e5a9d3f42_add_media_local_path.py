@@ -0,0 +1,24 @@
+"""Add media local path
+
+Revision ID: 7c1e5a9d3f42
+Revises: 2d7f9b3e6a05
+Create Date: 2026-10-19 02:13:47.502915
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7c1e5a9d3f42"
+down_revision = "2d7f9b3e6a05"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("media", sa.Column("local_path", sa.Text(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("media", "local_path")
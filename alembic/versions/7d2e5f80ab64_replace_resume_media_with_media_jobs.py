@@ -0,0 +1,65 @@
+"""Replace resume media with media jobs
+
+Revision ID: 7d2e5f80ab64
+Revises: 3f9a0c6d58e1
+Create Date: 2026-10-18 16:48:12.330571
+
+"""
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7d2e5f80ab64"
+down_revision = "3f9a0c6d58e1"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "media_jobs",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("channel_id", sa.BigInteger(), nullable=False),
+        sa.Column("message_id", sa.BigInteger(), nullable=False),
+        sa.Column(
+            "created_utc",
+            sa.TIMESTAMP(),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.ForeignKeyConstraint(
+            ["channel_id", "message_id"],
+            ["messages.channel_id", "messages.message_id"],
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "channel_id", "message_id", name="uq_media_jobs_channel_id_message_id"
+        ),
+    )
+
+    # Media left to download by previous runs
+    op.execute(
+        "INSERT INTO media_jobs (channel_id, message_id) "
+        "SELECT DISTINCT channel_id, message_id FROM resume_media"
+    )
+    op.drop_table("resume_media")
+
+
+def downgrade() -> None:
+    op.create_table(
+        "resume_media",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("channel_id", sa.BigInteger(), nullable=False),
+        sa.Column("message_id", sa.BigInteger(), nullable=False),
+        sa.Column("data", postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["channel_id", "message_id"],
+            ["messages.channel_id", "messages.message_id"],
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+    # Pending jobs are lost, resume_media needs the whole message
+    op.drop_table("media_jobs")
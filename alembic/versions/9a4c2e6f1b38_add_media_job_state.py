@@ -0,0 +1,68 @@
+"""Add media job state
+
+Revision ID: 9a4c2e6f1b38
+Revises: 5e93b7a0d1c4
+Create Date: 2026-10-18 23:05:51.674182
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "9a4c2e6f1b38"
+down_revision = "5e93b7a0d1c4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("media_jobs", sa.Column("media_id", sa.BigInteger(), nullable=True))
+    op.add_column("media_jobs", sa.Column("size", sa.BigInteger(), nullable=True))
+    op.add_column(
+        "media_jobs",
+        sa.Column("priority", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.add_column(
+        "media_jobs",
+        sa.Column("state", sa.Text(), server_default="pending", nullable=False),
+    )
+    op.add_column(
+        "media_jobs",
+        sa.Column("attempts", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.add_column("media_jobs", sa.Column("last_error", sa.Text(), nullable=True))
+    op.add_column(
+        "media_jobs", sa.Column("next_attempt_utc", sa.TIMESTAMP(), nullable=True)
+    )
+    op.add_column(
+        "media_jobs",
+        sa.Column(
+            "updated_utc",
+            sa.TIMESTAMP(),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+    )
+    op.create_index(
+        "ix_media_jobs_channel_id_state", "media_jobs", ["channel_id", "state"]
+    )
+
+    # Jobs left by previous runs
+    op.execute(
+        "UPDATE media_jobs SET media_id = media.media_id, size = media.size "
+        "FROM media WHERE media.channel_id = media_jobs.channel_id "
+        "AND media.message_id = media_jobs.message_id"
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_media_jobs_channel_id_state", table_name="media_jobs")
+    op.drop_column("media_jobs", "updated_utc")
+    op.drop_column("media_jobs", "next_attempt_utc")
+    op.drop_column("media_jobs", "last_error")
+    op.drop_column("media_jobs", "attempts")
+    op.drop_column("media_jobs", "state")
+    op.drop_column("media_jobs", "priority")
+    op.drop_column("media_jobs", "size")
+    op.drop_column("media_jobs", "media_id")
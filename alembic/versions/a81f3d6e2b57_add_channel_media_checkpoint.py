@@ -0,0 +1,29 @@
+"""Add channel media checkpoint
+
+Revision ID: a81f3d6e2b57
+Revises: 5b7e2c91d04a
+Create Date: 2026-10-18 11:40:05.913266
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a81f3d6e2b57"
+down_revision = "5b7e2c91d04a"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "channels",
+        sa.Column(
+            "media_checkpoint_id", sa.BigInteger(), server_default="0", nullable=False
+        ),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("channels", "media_checkpoint_id")
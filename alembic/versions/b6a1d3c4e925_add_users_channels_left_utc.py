@@ -0,0 +1,26 @@
+"""Add users channels left utc
+
+Revision ID: b6a1d3c4e925
+Revises: 7d2e5f80ab64
+Create Date: 2026-10-18 18:05:44.120987
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b6a1d3c4e925"
+down_revision = "7d2e5f80ab64"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "users_channels", sa.Column("left_utc", sa.TIMESTAMP(), nullable=True)
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("users_channels", "left_utc")
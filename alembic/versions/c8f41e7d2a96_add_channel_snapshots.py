@@ -0,0 +1,59 @@
+"""Add channel snapshots
+
+Revision ID: c8f41e7d2a96
+Revises: b6a1d3c4e925
+Create Date: 2026-10-18 19:12:05.903417
+
+"""
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c8f41e7d2a96"
+down_revision = "b6a1d3c4e925"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "channel_snapshots",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("channel_id", sa.BigInteger(), nullable=False),
+        sa.Column("participants_count", sa.Integer(), nullable=True),
+        sa.Column("about", sa.Text(), nullable=True),
+        sa.Column("data", postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column("content_hash", sa.Text(), nullable=False),
+        sa.Column(
+            "retrieved_utc",
+            sa.TIMESTAMP(),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.Column(
+            "checked_utc",
+            sa.TIMESTAMP(),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.ForeignKeyConstraint(
+            ["channel_id"],
+            ["channels.channel_id"],
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_channel_snapshots_channel_id"),
+        "channel_snapshots",
+        ["channel_id"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        op.f("ix_channel_snapshots_channel_id"), table_name="channel_snapshots"
+    )
+    op.drop_table("channel_snapshots")
@@ -0,0 +1,51 @@
+"""Add backfill ranges
+
+Revision ID: e4c07b9a13f2
+Revises: a81f3d6e2b57
+Create Date: 2026-10-18 14:02:37.518240
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e4c07b9a13f2"
+down_revision = "a81f3d6e2b57"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "backfill_ranges",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("channel_id", sa.BigInteger(), nullable=False),
+        sa.Column("start_id", sa.BigInteger(), nullable=False),
+        sa.Column("end_id", sa.BigInteger(), nullable=False),
+        sa.Column("checkpoint_id", sa.BigInteger(), nullable=False),
+        sa.Column(
+            "retrieved_utc",
+            sa.TIMESTAMP(),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.Column(
+            "updated_utc",
+            sa.TIMESTAMP(),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.ForeignKeyConstraint(
+            ["channel_id"],
+            ["channels.channel_id"],
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "channel_id", "start_id", name="uq_backfill_ranges_channel_id_start_id"
+        ),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("backfill_ranges")
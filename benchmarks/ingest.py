@@ -0,0 +1,99 @@
+"""
+Compare the rows per second of the INSERT and COPY write paths of PgDatabase.
+
+Synthetic messages (and their media) are written to a scratch channel inside
+a transaction that is rolled back at the end, so the database is left as it
+was found.
+
+    poetry run python -m benchmarks.ingest [--batches N]
+"""
+import argparse
+import time
+from datetime import datetime, timezone
+
+from telethon.tl import types
+
+from telegram.common import BATCH_SIZE
+from telegram.database import PgDatabase
+from telegram.models import Channel, Media, Message
+
+CHANNEL_ID = -1
+
+
+def make_messages(first_id: int, count: int) -> list:
+    date = datetime.now(timezone.utc)
+    messages = []
+    for message_id in range(first_id, first_id + count):
+        media = None
+        if message_id % 4 == 0:
+            media = types.MessageMediaPhoto(
+                photo=types.Photo(
+                    id=message_id,
+                    access_hash=message_id,
+                    file_reference=b"\x00" * 16,
+                    date=date,
+                    sizes=[types.PhotoSize(type="x", w=800, h=600, size=65536)],
+                    dc_id=1,
+                )
+            )
+
+        messages.append(
+            types.Message(
+                id=message_id,
+                peer_id=types.PeerChannel(channel_id=CHANNEL_ID),
+                date=date,
+                message=f"Message {message_id}\twith\nsome \\ text",
+                from_id=types.PeerUser(user_id=message_id % 100),
+                views=message_id,
+                forwards=0,
+                media=media,
+            )
+        )
+
+    return messages
+
+
+def run(db: PgDatabase, batches: int) -> float:
+    db.upsert_channel(Channel(channel_id=CHANNEL_ID, name="benchmark"))
+
+    rows = 0
+    elapsed = 0.0
+    for batch in range(batches):
+        messages = make_messages(batch * BATCH_SIZE + 1, BATCH_SIZE)
+        message_records = [
+            Message(message, channel_id=CHANNEL_ID) for message in messages
+        ]
+        media_records = [
+            Media(message, channel_id=CHANNEL_ID)
+            for message in messages
+            if message.media
+        ]
+
+        start = time.perf_counter()
+        db.insert_messages(message_records)
+        db.flush_changes()
+        db.insert_media(media_records)
+        db.flush_changes()
+        elapsed += time.perf_counter() - start
+
+        rows += len(message_records) + len(media_records)
+
+    db.session.rollback()
+
+    return rows / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PgDatabase write paths")
+    parser.add_argument(
+        "--batches", type=int, default=20, help="number of batches to write"
+    )
+    args = parser.parse_args()
+
+    for name, bulk_insert in [("insert", False), ("copy", True)]:
+        rate = run(PgDatabase(bulk_insert=bulk_insert), args.batches)
+        print(f"{name:>6}: {rate:,.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
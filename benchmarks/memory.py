@@ -0,0 +1,176 @@
+"""
+Measure the peak memory (RSS) of downloading dialogs of growing sizes, with
+media that is slower to download than messages are to fetch.
+
+Each size runs in a process of its own, against a fake client that makes up
+messages with a photo as they are fetched. The scratch channel is deleted from
+the database afterwards, and its media from a temporary folder.
+
+    poetry run python -m benchmarks.memory [--sizes N N ...] [--media-delay S]
+"""
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import types as pytypes
+from datetime import datetime, timezone
+from typing import cast
+
+from telethon.tl import types
+
+from telegram.client import TelegramClient
+from telegram.database import PgDatabase, init_async_database
+from telegram.download import Downloader
+from telegram.models import (
+    BackfillRange,
+    Channel,
+    ChannelSnapshot,
+    Lease,
+    Media,
+    MediaJob,
+    Message,
+)
+
+CHANNEL_ID = -1
+
+# Text of each message, so that holding on to messages shows
+TEXT = "x" * 4096
+
+
+def make_message(message_id: int) -> types.Message:
+    date = datetime.now(timezone.utc)
+    photo = types.Photo(
+        id=message_id,
+        access_hash=message_id,
+        file_reference=b"\x00" * 16,
+        date=date,
+        sizes=[types.PhotoSize(type="x", w=800, h=600, size=65536)],
+        dc_id=1,
+    )
+    return types.Message(
+        id=message_id,
+        peer_id=types.PeerChannel(channel_id=CHANNEL_ID),
+        date=date,
+        message=TEXT,
+        media=types.MessageMediaPhoto(photo=photo),
+    )
+
+
+class FakeClient:
+    def __init__(self, size: int, media_delay: float) -> None:
+        self.size = size
+        self.media_delay = media_delay
+
+    async def get_dialogs(self) -> list:
+        dialog = pytypes.SimpleNamespace(
+            id=CHANNEL_ID,
+            title="benchmark",
+            name="benchmark",
+            is_channel=False,
+            message=make_message(self.size),
+        )
+        return [dialog]
+
+    async def fetch_messages(self, dialog, limit, max_id=None, min_id=None, **kw):
+        # Oldest first, like the reverse fetches of the downloader
+        first = (min_id or 0) + 1
+        last = min(first + limit, max_id or self.size + 1, self.size + 1)
+        return [make_message(message_id) for message_id in range(first, last)]
+
+    async def fetch_messages_by_ids(self, dialog, ids) -> list:
+        return [make_message(message_id) for message_id in ids]
+
+    async def get_media(self, media, filename, callback=None) -> None:
+        await asyncio.sleep(self.media_delay)
+        with open(filename, "w") as f:
+            f.write("x")
+
+
+def cleanup() -> None:
+    db = PgDatabase()
+    for model in (Media, MediaJob, BackfillRange, ChannelSnapshot, Message):
+        db.session.query(model).filter(model.channel_id == CHANNEL_ID).delete()
+    db.session.query(Lease).filter(Lease.key == CHANNEL_ID).delete()
+    db.session.query(Channel).filter(Channel.channel_id == CHANNEL_ID).delete()
+    db.commit_changes()
+
+
+async def download(size: int, media_delay: float) -> None:
+    args = pytypes.SimpleNamespace(
+        without_media=False,
+        concurrency=1,
+        media_workers=1,
+        backfill_ranges=1,
+        ignore_schedule=True,
+    )
+    # Only the requests the downloader makes are faked
+    client = cast(TelegramClient, FakeClient(size, media_delay))
+
+    db = init_async_database(args.concurrency)
+    try:
+        await Downloader(args, client, db).download_dialogs()
+    finally:
+        await db.release()
+
+
+def run(size: int, media_delay: float) -> None:
+    # Media is written to a temporary folder, once the config has been read
+    with tempfile.TemporaryDirectory() as folder:
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            asyncio.run(download(size, media_delay))
+        finally:
+            os.chdir(cwd)
+            cleanup()
+
+    # In kilobytes on Linux
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark peak memory")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 4000, 16000],
+        help="number of messages of the dialogs",
+    )
+    parser.add_argument(
+        "--media-delay",
+        type=float,
+        default=0.002,
+        help="seconds taken to download each media",
+    )
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run(args.run, args.media_delay)
+        return
+
+    for size in args.sizes:
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.memory",
+                "--run",
+                str(size),
+                "--media-delay",
+                str(args.media_delay),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        peak = int(output.split()[-1]) / 1024
+        print(f"{size:>8,} messages: {peak:.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
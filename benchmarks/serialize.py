@@ -0,0 +1,53 @@
+"""
+Compare the cost and size of serializing messages into the data column with
+TLObject.to_json and with to_native, with and without a field projection.
+
+The to_json path is measured as it used to reach the database: the string it
+returns was serialized once more by the JSONB column.
+
+    poetry run python -m benchmarks.serialize [--messages N]
+"""
+import argparse
+import json
+import time
+from typing import Callable, List
+
+from benchmarks.ingest import make_messages
+from telegram.serialize import dumps, to_native
+
+# Projection keeping what the messages table doesn't already have in columns
+PROJECTION = ["id", "date", "edit_date", "reply_to", "media", "entities", "grouped_id"]
+
+
+def run(messages: list, serialize: Callable) -> List[float]:
+    size = 0
+    start = time.perf_counter()
+    for message in messages:
+        size += len(serialize(message))
+    elapsed = time.perf_counter() - start
+
+    return [len(messages) / elapsed, size / len(messages)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark message serialization")
+    parser.add_argument(
+        "--messages", type=int, default=20000, help="number of messages to serialize"
+    )
+    args = parser.parse_args()
+
+    messages = make_messages(1, args.messages)
+    paths = [
+        ("to_json", lambda message: json.dumps(message.to_json())),
+        ("native", lambda message: json.dumps(to_native(message))),
+        ("orjson", lambda message: dumps(to_native(message))),
+        ("projected", lambda message: dumps(to_native(message, PROJECTION))),
+    ]
+
+    for name, serialize in paths:
+        rate, size = run(messages, serialize)
+        print(f"{name:>9}: {rate:,.0f} messages/s, {size:,.0f} bytes/message")
+
+
+if __name__ == "__main__":
+    main()
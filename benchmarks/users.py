@@ -0,0 +1,102 @@
+"""
+Compare the cost of writing a page of participants as the users and
+users_channels tables grow, with the old dedup (every stored ID loaded and
+searched in Python) and with the upserts of PgDatabase.
+
+Synthetic users are written to a scratch channel inside a transaction that is
+rolled back at the end, so the database is left as it was found.
+
+    poetry run python -m benchmarks.users [--pages N] [--page-size N]
+"""
+import argparse
+import time
+from typing import List
+
+from sqlalchemy import select
+from telethon.tl import types
+
+from telegram.database import PgDatabase
+from telegram.models import Channel, User, UserChannel
+
+CHANNEL_ID = -1
+
+
+def make_users(first_id: int, count: int) -> List[types.User]:
+    return [
+        types.User(id=user_id, first_name=f"User {user_id}", username=f"u{user_id}")
+        for user_id in range(first_id, first_id + count)
+    ]
+
+
+def insert_scanning(db: PgDatabase, users: list, users_channels: list) -> None:
+    # How participants used to be written
+    existing = db.session.execute(select(User.user_id)).scalars().all()
+    db.session.add_all([user for user in users if user.user_id not in existing])
+    db.flush_changes()
+
+    existing = db.session.execute(
+        select(UserChannel.channel_id, UserChannel.user_id)
+    ).all()
+    db.session.add_all(
+        [uc for uc in users_channels if (uc.channel_id, uc.user_id) not in existing]
+    )
+    db.flush_changes()
+
+
+def insert_upserting(db: PgDatabase, users: list, users_channels: list) -> None:
+    db.insert_users(users)
+    db.flush_changes()
+    db.insert_users_channels(users_channels)
+    db.flush_changes()
+
+
+def run(db: PgDatabase, insert, pages: int, page_size: int) -> List[float]:
+    db.upsert_channel(Channel(channel_id=CHANNEL_ID, name="benchmark"))
+
+    # Milliseconds taken by each page
+    timings = []
+    for page in range(pages):
+        users = make_users(page * page_size + 1, page_size)
+        user_records = [User(user) for user in users]
+        user_channel_records = [
+            UserChannel(channel_id=CHANNEL_ID, user_id=user.id) for user in users
+        ]
+
+        start = time.perf_counter()
+        insert(db, user_records, user_channel_records)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    db.session.rollback()
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark participant writes")
+    parser.add_argument(
+        "--pages", type=int, default=50, help="number of pages of users to write"
+    )
+    parser.add_argument(
+        "--page-size", type=int, default=200, help="number of users in a page"
+    )
+    args = parser.parse_args()
+
+    # Report the pages written at a few sizes of the tables
+    checkpoints = sorted({0, args.pages // 4, args.pages // 2, args.pages - 1})
+    paths = [
+        ("scan", insert_scanning, False),
+        ("insert", insert_upserting, False),
+        ("copy", insert_upserting, True),
+    ]
+
+    for name, insert, bulk_insert in paths:
+        timings = run(PgDatabase(bulk_insert), insert, args.pages, args.page_size)
+        cells = ", ".join(
+            f"{page * args.page_size:,} rows: {timings[page]:.1f}ms"
+            for page in checkpoints
+        )
+        print(f"{name:>6}: {cells}")
+
+
+if __name__ == "__main__":
+    main()
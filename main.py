@@ -2,12 +2,12 @@ import argparse
 import asyncio
 from contextlib import suppress
 
-from telegram.client import AsyncTelegramClient
+from telegram.client import init_client
 from telegram.common import logger
-from telegram.database import PgDatabase
+from telegram.database import init_async_database
 from telegram.download import Downloader
 from telegram.search import Searcher
-from telegram.utils import print_dialogs
+from telegram.utils import print_dialogs, print_schedule
 
 
 def parse_args():
@@ -23,6 +23,18 @@ def parse_args():
         "--list-dialogs", action="store_true", help="list dialogs and exit"
     )
 
+    parser.add_argument(
+        "--list-schedule",
+        action="store_true",
+        help="list when each dialog is next polled for new messages and exit",
+    )
+
+    parser.add_argument(
+        "--ignore-schedule",
+        action="store_true",
+        help="poll every dialog for new messages, even the ones not due yet",
+    )
+
     parser.add_argument(
         "--get-participants",
         action="store_true",
@@ -53,20 +65,72 @@ def parse_args():
         help="download telegram data (chats and messages) without downloading media",
     )
 
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="keep running, and download new messages as they are posted",
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="number of dialogs to download at the same time",
+    )
+
+    parser.add_argument(
+        "--backfill-ranges",
+        type=int,
+        default=1,
+        help="number of message ID ranges of a dialog to download at the same time",
+    )
+
+    parser.add_argument(
+        "--media-workers",
+        type=int,
+        default=4,
+        help="number of media files to download at the same time for each dialog",
+    )
+
     return parser.parse_args()
 
 
+async def run(args, client, db):
+    """
+    Run the action selected by the command line arguments.
+    """
+
+    if args.list_schedule is True:
+        print_schedule(await db.get_channels())
+    elif args.search_twitter or args.search_messages:
+        searcher = Searcher(args=args, client=client, db=db)
+        if args.search_twitter:
+            await searcher.search_twitter()
+        elif args.search_messages:
+            await searcher.search_messages()
+    else:
+        downloader = Downloader(args=args, client=client, db=db)
+        if args.get_participants is True:
+            await downloader.download_participants_from_dialogs()
+        elif args.download_past_media is True:
+            await downloader.download_past_media_from_dialogs()
+        elif args.follow is True:
+            await downloader.follow()
+        else:
+            await downloader.download_dialogs()
+
+
 async def main():
     """
     The main telegram-bot program. Goes through all the subscribed dialogs and dumps them.
     """
     args = parse_args()
-    db = PgDatabase()
-    client = AsyncTelegramClient()
+    db = init_async_database(concurrency=args.concurrency)
+    client = init_client()
     await client.connect()
 
     if args.log_in is True:
-        await client.client.start()
+        await client.log_in()
         return
 
     if args.list_dialogs is True:
@@ -75,24 +139,12 @@ async def main():
         return
 
     try:
-        if args.search_twitter or args.search_messages:
-            searcher = Searcher(args=args, client=client, db=db)
-            if args.search_twitter:
-                await searcher.search_twitter()
-            elif args.search_messages:
-                await searcher.search_messages()
-        else:
-            downloader = Downloader(args=args, client=client, db=db)
-            if args.get_participants is True:
-                await downloader.download_participants_from_dialogs()
-            elif args.download_past_media is True:
-                await downloader.download_past_media_from_dialogs()
-            else:
-                await downloader.download_dialogs()
-
+        await run(args, client, db)
     except asyncio.CancelledError:
         pass
     finally:
+        await db.release()
+
         logger.info("Disconnecting client")
         await client.disconnect()
 
@@ -2,7 +2,12 @@ import argparse
 from datetime import date
 
 from telegram.database import PgDatabase
-from telegram.scripts import activity_over_time, export, inactive_users
+from telegram.scripts import (
+    activity_over_time,
+    export,
+    inactive_users,
+    migrate_downloads,
+)
 
 
 def parse_args():
@@ -65,6 +70,17 @@ def parse_args():
         "--compress", action="store_true", help="compress destination file"
     )
 
+    # Parser options for migrate_downloads
+    parser_md = subparsers.add_parser(
+        "migrate-downloads",
+        help="moves media from folders named by title to folders named by id",
+    )
+    parser_md.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only list the folders that would be moved",
+    )
+
     return parser.parse_args()
 
 
@@ -83,6 +99,8 @@ def main():
             inactive_users(args, db)
         case "export":
             export(args)
+        case "migrate-downloads":
+            migrate_downloads(args, db)
 
 
 if __name__ == "__main__":
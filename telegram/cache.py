@@ -0,0 +1,64 @@
+import os
+import sqlite3
+import time
+from typing import Optional, Tuple
+
+from .common import config
+
+# Seconds a resolved username is trusted for, a week by default
+ENTITY_CACHE_TTL = config.get("entity_cache_ttl", 7 * 24 * 3600)
+
+
+class EntityCache:
+    """
+    Usernames resolved by Telegram, kept in a SQLite file next to the session
+    so that they outlive the process. Each username maps to the kind of its
+    entity ("channel", "user", or "invalid" when it doesn't exist), with the
+    ID and access hash needed to request the entity without resolving again.
+    """
+
+    def __init__(self, path: str, ttl: float = ENTITY_CACHE_TTL) -> None:
+        self.ttl = ttl
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS usernames ("
+            "username TEXT PRIMARY KEY, kind TEXT NOT NULL, "
+            "id INTEGER, access_hash INTEGER, resolved REAL NOT NULL)"
+        )
+
+        # Evict stale entries
+        self.connection.execute(
+            "DELETE FROM usernames WHERE resolved < ?", (time.time() - ttl,)
+        )
+        self.connection.commit()
+
+    def get(self, username: str) -> Optional[Tuple[str, int, int]]:
+        """
+        Return the kind, ID and access hash of a username, if resolved recently.
+        """
+
+        row = self.connection.execute(
+            "SELECT kind, id, access_hash FROM usernames "
+            "WHERE username = ? AND resolved >= ?",
+            (username.lower(), time.time() - self.ttl),
+        ).fetchone()
+
+        return tuple(row) if row is not None else None
+
+    def put(
+        self,
+        username: str,
+        kind: str,
+        id: Optional[int] = None,
+        access_hash: Optional[int] = None,
+    ) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO usernames VALUES (?, ?, ?, ?, ?)",
+            (username.lower(), kind, id, access_hash, time.time()),
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
@@ -1,12 +1,33 @@
-import json
+import asyncio
+import string
 from abc import ABC, abstractmethod
-from typing import Callable, List, Optional
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
 
 from telethon import TelegramClient as AsyncTelegram
-from telethon import errors
+from telethon import errors, events
 from telethon.tl import functions, types
 
-from .common import config, logger
+from .cache import EntityCache
+from .common import (
+    CHAT_DELAY,
+    HISTORY_DELAY,
+    MEDIA_DELAY,
+    MEDIA_PART_DELAY,
+    config,
+    logger,
+)
+from .media import MediaItem
+from .ratelimit import RateLimiter
+from .serialize import to_native
 
 
 def _handle_chat(chat: types.Chat, min_participants: int = 50) -> Optional[types.Chat]:
@@ -41,6 +62,10 @@ def _handle_chat(chat: types.Chat, min_participants: int = 50) -> Optional[types
     return chat
 
 
+def _link_username(link: str) -> str:
+    return link.rstrip("/").split("/")[-1].lstrip("@").lower()
+
+
 def _handle_chat_invite(
     chat_invite: types.ChatInvite, min_participants: int = 50
 ) -> Optional[types.ChatInvite]:
@@ -66,6 +91,10 @@ class TelegramClient(ABC):
     async def connect(self) -> None:
         pass
 
+    @abstractmethod
+    async def log_in(self) -> None:
+        pass
+
     @abstractmethod
     async def disconnect(self) -> None:
         pass
@@ -81,18 +110,28 @@ class TelegramClient(ABC):
     ) -> List[types.Message]:
         pass
 
+    @abstractmethod
+    async def fetch_messages_by_ids(
+        self, dialog: Optional[types.Dialog], ids: List[int]
+    ) -> List[Optional[types.Message]]:
+        pass
+
     @abstractmethod
     async def get_media(
-        self, message: types.Message, filename: str, callback: Optional[Callable] = None
+        self, media: MediaItem, filename: str, callback: Optional[Callable] = None
     ) -> None:
         pass
 
+    @abstractmethod
+    async def get_media_part(self, media: MediaItem, offset: int, limit: int) -> bytes:
+        pass
+
     @abstractmethod
     async def get_entity_from_id(self, id: int) -> Optional[types.Dialog]:
         pass
 
     @abstractmethod
-    async def get_dialog_info(self, dialog: types.Dialog) -> types.messages.ChatFull:
+    async def get_dialog_info(self, dialog: types.Dialog) -> Dict[str, Any]:
         pass
 
     @abstractmethod
@@ -101,10 +140,26 @@ class TelegramClient(ABC):
     ) -> List[types.User]:
         pass
 
+    @abstractmethod
+    def iter_dialog_users(
+        self, dialog: types.Dialog
+    ) -> AsyncIterator[Tuple[List[types.User], int]]:
+        pass
+
     @abstractmethod
     async def get_dialogs(self, limit: float = 1000) -> List[types.Dialog]:
         pass
 
+    @abstractmethod
+    def add_message_handler(
+        self, callback: Callable[[types.Message, bool], Awaitable]
+    ) -> None:
+        pass
+
+    @abstractmethod
+    async def resolve_public_links(self, links: List[str]) -> None:
+        pass
+
     @abstractmethod
     async def join_private_channel(self, link: str) -> None:
         pass
@@ -123,17 +178,62 @@ class TelegramClient(ABC):
 
 
 class AsyncTelegramClient(TelegramClient):
-    def __init__(self) -> None:
+    def __init__(self, session: Optional[str] = None) -> None:
+        self.session = session or config["session"]
         self.client = AsyncTelegram(
-            f'config/{config["session"]}',
+            f"config/{self.session}",
             config["api_id"],
             config["api_hash"],
+            # Flood waits are handled by our own rate limiters
+            flood_sleep_threshold=0,
         )
 
+        # One rate limiter per class of requests
+        self.limiters: Dict[str, RateLimiter] = {
+            "history": RateLimiter("history", HISTORY_DELAY),
+            "media": RateLimiter("media", MEDIA_DELAY),
+            "media_part": RateLimiter("media_part", MEDIA_PART_DELAY),
+            "resolve": RateLimiter("resolve", CHAT_DELAY),
+            "join": RateLimiter("join", CHAT_DELAY),
+        }
+
+        # Resolved usernames, kept across runs and, with their entities, for
+        # the current run
+        self.cache = EntityCache(f"config/{self.session}.entities")
+        self._entities: Dict[str, Any] = {}
+
+    async def _request(
+        self, kind: str, function: Callable[..., Awaitable], *args, **kwargs
+    ) -> Any:
+        """
+        Make a request through the rate limiter of its kind, waiting and
+        retrying as long as Telegram asks us to.
+        """
+
+        limiter = self.limiters[kind]
+        while True:
+            await limiter.acquire()
+            try:
+                result = await function(*args, **kwargs)
+            except errors.FloodWaitError as e:
+                logger.warning(f"Waiting {e.seconds}s before new {kind} requests")
+                limiter.flood_wait(e.seconds)
+                continue
+
+            limiter.success()
+            return result
+
     async def connect(self) -> None:
         await self.client.connect()
 
+    async def log_in(self) -> None:
+        await self.client.start()
+
     async def disconnect(self) -> None:
+        for limiter in self.limiters.values():
+            logger.info(f"Rate limiter {self.session} {limiter}")
+
+        self.cache.close()
         await self.client.disconnect()
 
     async def fetch_messages(
@@ -148,7 +248,22 @@ class AsyncTelegramClient(TelegramClient):
                 if locals()[key] is not None:
                     kwargs[key] = locals()[key]
 
-            messages = await self.client.get_messages(*params, **kwargs)
+            messages = await self._request(
+                "history", self.client.get_messages, *params, **kwargs
+            )
+        except ValueError as e:
+            logger.warning(str(e))
+            raise e
+
+        return messages
+
+    async def fetch_messages_by_ids(
+        self, dialog: Optional[types.Dialog], ids: List[int]
+    ) -> List[Optional[types.Message]]:
+        try:
+            messages = await self._request(
+                "history", self.client.get_messages, dialog, ids=ids
+            )
         except ValueError as e:
             logger.warning(str(e))
             raise e
@@ -156,51 +271,150 @@ class AsyncTelegramClient(TelegramClient):
         return messages
 
     async def get_media(
-        self, message: types.Message, filename: str, callback: Optional[Callable] = None
+        self, media: MediaItem, filename: str, callback: Optional[Callable] = None
     ) -> None:
         try:
-            result = await self.client.download_media(
-                message=message, file=filename, progress_callback=callback
+            await self._request(
+                "media",
+                self.client.download_file,
+                media.location,
+                filename,
+                file_size=media.size or None,
+                progress_callback=callback,
+                dc_id=media.dc_id,
             )
         except Exception as e:
             logger.warning(str(e))
             raise e
 
+    async def get_media_part(self, media: MediaItem, offset: int, limit: int) -> bytes:
+        """
+        Download limit bytes of a document from offset on. Parts must not cross
+        a 1MB boundary of the file. Telethon fetches them in requests of at most
+        512KB.
+        """
+
+        async def download_part() -> bytes:
+            async for chunk in self.client.iter_download(
+                media.location,
+                offset=offset,
+                limit=1,
+                chunk_size=limit,
+                file_size=media.size,
+                dc_id=media.dc_id,
+            ):
+                # Parts made of several requests come as memoryviews
+                return bytes(chunk)
+            return b""
+
+        return await self._request("media_part", download_part)
+
     async def get_entity_from_id(self, id: int) -> Optional[types.Dialog]:
         try:
-            entity = await self.client.get_entity(id)
+            entity = await self._request("resolve", self.client.get_entity, id)
         except ValueError as e:
             logger.warning(str(e))
             return None
 
         return entity
 
-    async def get_dialog_info(self, dialog: types.Dialog) -> types.messages.ChatFull:
+    async def get_dialog_info(self, dialog: types.Dialog) -> Dict[str, Any]:
+        """
+        Return the full info of a channel as JSON-native values.
+        """
+
         try:
-            data = await self.client(
-                functions.channels.GetFullChannelRequest(channel=dialog)
+            data = await self._request(
+                "history",
+                self.client,
+                functions.channels.GetFullChannelRequest(channel=dialog),
             )
         except ValueError as e:
             logger.warning(str(e))
             raise e
 
-        return json.loads(data.to_json())
+        return to_native(data)
 
     async def get_dialog_users(
         self, dialog: types.Dialog, limit: int = 10000
     ) -> List[types.User]:
         try:
             # Telegram API's limit the number of users we can retrieve to 10k
-            participants = await self.client.get_participants(dialog, limit)
+            participants = await self._request(
+                "history", self.client.get_participants, dialog, limit
+            )
         except errors.ChatAdminRequiredError as e:
             logger.warning(str(e))
             return []
 
         return participants
 
+    async def iter_dialog_users(
+        self, dialog: types.Dialog, page_size: int = 200
+    ) -> AsyncIterator[Tuple[List[types.User], int]]:
+        """
+        Yield the participants of a dialog page by page, along with how many
+        participants it has. Telegram lists at most 10k participants for a
+        search, so the names of larger channels are searched again by their
+        first characters. Participants may be yielded more than once.
+        """
+
+        if not isinstance(dialog.entity, types.Channel):
+            # Small groups list all their participants at once
+            users = await self.get_dialog_users(dialog)
+            yield users, len(users)
+            return
+
+        total = None
+        queries = [""]
+        while queries:
+            query = queries.pop(0)
+            offset = 0
+            while True:
+                try:
+                    result = await self._request(
+                        "history",
+                        self.client,
+                        functions.channels.GetParticipantsRequest(
+                            channel=dialog.entity,
+                            filter=types.ChannelParticipantsSearch(query),
+                            offset=offset,
+                            limit=page_size,
+                            hash=0,
+                        ),
+                    )
+                except errors.ChatAdminRequiredError as e:
+                    logger.warning(str(e))
+                    return
+
+                if total is None:
+                    total = result.count
+
+                if not result.participants:
+                    break
+
+                offset += len(result.participants)
+
+                # result.users also has the users the participants only refer
+                # to, such as who invited or promoted them
+                users_by_id = {user.id: user for user in result.users}
+                page = [
+                    users_by_id[participant.user_id]
+                    for participant in result.participants
+                    if getattr(participant, "user_id", None) in users_by_id
+                ]
+                yield page, total
+
+                if offset >= result.count:
+                    break
+
+            # Telegram stopped listing before the end, narrow the search down
+            if offset < result.count:
+                queries += [query + c for c in string.ascii_lowercase + string.digits]
+
     async def get_dialogs(self, limit: float = 1000) -> List[types.Dialog]:
         try:
-            dialogs = await self.client.get_dialogs(limit)
+            dialogs = await self._request("history", self.client.get_dialogs, limit)
             dialogs = [
                 dialog for dialog in dialogs if dialog.is_group or dialog.is_channel
             ]
@@ -210,13 +424,110 @@ class AsyncTelegramClient(TelegramClient):
 
         return dialogs
 
+    def add_message_handler(
+        self, callback: Callable[[types.Message, bool], Awaitable]
+    ) -> None:
+        """
+        Call back with every new and edited message pushed by Telegram, and
+        whether it was edited.
+        """
+
+        async def on_new_message(event: events.NewMessage.Event) -> None:
+            await callback(event.message, False)
+
+        async def on_message_edited(event: events.MessageEdited.Event) -> None:
+            await callback(event.message, True)
+
+        self.client.add_event_handler(on_new_message, events.NewMessage())
+        self.client.add_event_handler(on_message_edited, events.MessageEdited())
+
+    async def _resolve(self, link: str) -> Optional[Any]:
+        """
+        Get the entity of a public link, only asking Telegram to resolve its
+        username if it isn't cached. Returns None for usernames known not to
+        exist.
+        """
+
+        username = _link_username(link)
+        if username in self._entities:
+            return self._entities[username]
+
+        cached = self.cache.get(username)
+        match cached:
+            case ("invalid", _, _):
+                entity = None
+            case ("user", id, access_hash):
+                entity = types.User(id=id, access_hash=access_hash)
+            case ("channel", id, access_hash):
+                result = await self._request(
+                    "resolve",
+                    self.client,
+                    functions.channels.GetChannelsRequest(
+                        [types.InputChannel(id, access_hash)]
+                    ),
+                )
+                entity = result.chats[0]
+            case _:
+                try:
+                    entity = await self._request(
+                        "resolve", self.client.get_entity, username
+                    )
+                except (
+                    errors.UsernameInvalidError,
+                    errors.UsernameNotOccupiedError,
+                    ValueError,
+                ):
+                    self.cache.put(username, "invalid")
+                    raise
+
+                if isinstance(entity, types.User):
+                    self.cache.put(username, "user", entity.id, entity.access_hash)
+                elif isinstance(entity, types.Channel):
+                    self.cache.put(username, "channel", entity.id, entity.access_hash)
+
+        self._entities[username] = entity
+        return entity
+
+    async def resolve_public_links(self, links: List[str]) -> None:
+        """
+        Get the entities of the public links with cached usernames ahead of
+        time, a hundred channels per request, so that checking and joining
+        them doesn't resolve them one by one.
+        """
+
+        usernames: Dict[int, str] = {}
+        input_channels = []
+        for link in links:
+            username = _link_username(link)
+            if username in self._entities:
+                continue
+
+            match self.cache.get(username):
+                case ("channel", id, access_hash) if id not in usernames:
+                    usernames[id] = username
+                    input_channels.append(types.InputChannel(id, access_hash))
+
+        for start in range(0, len(input_channels), 100):
+            end = start + 100
+            result = await self._request(
+                "resolve",
+                self.client,
+                functions.channels.GetChannelsRequest(input_channels[start:end]),
+            )
+            for chat in result.chats:
+                self._entities[usernames[chat.id]] = chat
+
     async def join_private_channel(self, link: str) -> None:
         try:
             # Extract hash from invite link
             hash = "".join(link.split("/")[:-1])
             hash = hash.replace("+", "")
 
-            await self.client(functions.messages.ImportChatInviteRequest(hash=hash))
+            await self._request(
+                "join",
+                self.client,
+                functions.messages.ImportChatInviteRequest(hash=hash),
+            )
 
         except (
             errors.InviteHashExpiredError,
@@ -230,14 +541,18 @@ class AsyncTelegramClient(TelegramClient):
 
     async def join_public_channel(self, link: str) -> None:
         try:
-            entity = await self.client.get_entity(link)
+            entity = await self._resolve(link)
 
             if isinstance(entity, types.Channel):
                 logger.info(f"Joining channel {entity.title}")
-                await self.client(functions.channels.JoinChannelRequest(entity))
+                await self._request(
+                    "join", self.client, functions.channels.JoinChannelRequest(entity)
+                )
             elif isinstance(entity, types.Chat):
                 logger.info(f"Joining chat {entity.title}")
-                await self.client(functions.channels.JoinChannelRequest(entity))
+                await self._request(
+                    "join", self.client, functions.channels.JoinChannelRequest(entity)
+                )
 
         except (
             errors.ChannelPrivateError,
@@ -256,8 +571,10 @@ class AsyncTelegramClient(TelegramClient):
             hash = hash.replace("+", "")
 
             # Check if its valid
-            chat_invite = await self.client(
-                functions.messages.CheckChatInviteRequest(hash=hash)
+            chat_invite = await self._request(
+                "resolve",
+                self.client,
+                functions.messages.CheckChatInviteRequest(hash=hash),
             )
 
             match chat_invite:
@@ -290,10 +607,10 @@ class AsyncTelegramClient(TelegramClient):
 
     async def check_public_link(self, link: str, min_participants: int = 50) -> bool:
         try:
-            entity = await self.client.get_entity(link)
+            entity = await self._resolve(link)
 
-            # Do not consider users
-            if isinstance(entity, types.User):
+            # Do not consider users, nor usernames that don't exist
+            if entity is None or isinstance(entity, types.User):
                 return False
 
             if _handle_chat(entity, min_participants) is None:
@@ -313,3 +630,169 @@ class AsyncTelegramClient(TelegramClient):
         except Exception as e:
             logger.error(str(e))
             return False
+
+
+class ClientPool(TelegramClient):
+    """
+    Several accounts used as one client, so that their rate limits add up.
+    Requests about a dialog go to whichever account that is a member of it
+    would send them the soonest, using its own copy of the dialog (access
+    hashes differ between accounts). Media is downloaded by the account that
+    fetched its message, and links are searched and joined by the first one.
+    """
+
+    def __init__(self, sessions: List[str]) -> None:
+        self.clients = [AsyncTelegramClient(session) for session in sessions]
+
+        # The accounts that are members of each dialog, with their dialog
+        self._members: Dict[int, List[Tuple[AsyncTelegramClient, types.Dialog]]] = {}
+
+    def _pick(
+        self, dialog: types.Dialog, kind: str
+    ) -> Tuple[AsyncTelegramClient, types.Dialog]:
+        members = self._members.get(dialog.id)
+        if not members:
+            return self.clients[0], dialog
+
+        # Message IDs of small groups are numbered for each account
+        if not dialog.is_channel:
+            return members[0]
+
+        return min(members, key=lambda member: member[0].limiters[kind].expected_wait())
+
+    def _owner(self, media: MediaItem) -> AsyncTelegramClient:
+        # Media can only be downloaded by the account that fetched it
+        for client in self.clients:
+            if client.client is media.source:
+                return client
+
+        return self.clients[0]
+
+    async def connect(self) -> None:
+        await asyncio.gather(*[client.connect() for client in self.clients])
+
+    async def log_in(self) -> None:
+        for client in self.clients:
+            logger.info(f"Logging in {client.session}")
+            await client.log_in()
+
+    async def disconnect(self) -> None:
+        for client in self.clients:
+            await client.disconnect()
+
+    async def fetch_messages(
+        self, dialog, limit=100, max_id=None, min_id=None, reverse=True
+    ):
+        client, dialog = self._pick(dialog, "history")
+        return await client.fetch_messages(dialog, limit, max_id, min_id, reverse)
+
+    async def fetch_messages_by_ids(
+        self, dialog: Optional[types.Dialog], ids: List[int]
+    ) -> List[Optional[types.Message]]:
+        client, dialog = self._pick(dialog, "history")
+        return await client.fetch_messages_by_ids(dialog, ids)
+
+    async def get_media(
+        self, media: MediaItem, filename: str, callback: Optional[Callable] = None
+    ) -> None:
+        await self._owner(media).get_media(media, filename, callback)
+
+    async def get_media_part(self, media: MediaItem, offset: int, limit: int) -> bytes:
+        return await self._owner(media).get_media_part(media, offset, limit)
+
+    async def get_entity_from_id(self, id: int) -> Optional[types.Dialog]:
+        return await self.clients[0].get_entity_from_id(id)
+
+    async def get_dialog_info(self, dialog: types.Dialog) -> Dict[str, Any]:
+        client, dialog = self._pick(dialog, "history")
+        return await client.get_dialog_info(dialog)
+
+    async def get_dialog_users(
+        self, dialog: types.Dialog, limit: int = 10000
+    ) -> List[types.User]:
+        client, dialog = self._pick(dialog, "history")
+        return await client.get_dialog_users(dialog, limit)
+
+    async def iter_dialog_users(
+        self, dialog: types.Dialog
+    ) -> AsyncIterator[Tuple[List[types.User], int]]:
+        # Offsets are only meaningful to a single account
+        client, dialog = self._pick(dialog, "history")
+        async for users, total in client.iter_dialog_users(dialog):
+            yield users, total
+
+    async def get_dialogs(self, limit: float = 1000) -> List[types.Dialog]:
+        """
+        Get the dialogs of every account, each dialog once, and remember which
+        accounts are members of which dialogs.
+        """
+
+        results = await asyncio.gather(
+            *[client.get_dialogs(limit) for client in self.clients]
+        )
+
+        self._members = {}
+        dialogs = []
+        for client, client_dialogs in zip(self.clients, results):
+            for dialog in client_dialogs:
+                if dialog.id not in self._members:
+                    self._members[dialog.id] = []
+                    dialogs.append(dialog)
+                self._members[dialog.id].append((client, dialog))
+
+        counts = ", ".join(
+            f"{client.session}: {len(client_dialogs)}"
+            for client, client_dialogs in zip(self.clients, results)
+        )
+        logger.info(f"Got {len(dialogs)} dialogs from the accounts ({counts})")
+
+        return dialogs
+
+    def add_message_handler(
+        self, callback: Callable[[types.Message, bool], Awaitable]
+    ) -> None:
+        """
+        Call back with the messages pushed to any account. Messages of dialogs
+        shared by several accounts are only passed on once, from the first
+        account that is a member.
+        """
+
+        for client in self.clients:
+
+            async def on_message(
+                message: types.Message, edited: bool, client=client
+            ) -> None:
+                members = self._members.get(message.chat_id)
+                first = members[0][0] if members else self.clients[0]
+                if client is first:
+                    await callback(message, edited)
+
+            client.add_message_handler(on_message)
+
+    async def resolve_public_links(self, links: List[str]) -> None:
+        await self.clients[0].resolve_public_links(links)
+
+    async def join_private_channel(self, link: str) -> None:
+        await self.clients[0].join_private_channel(link)
+
+    async def join_public_channel(self, link: str) -> None:
+        await self.clients[0].join_public_channel(link)
+
+    async def check_private_link(self, link: str, min_participants: int = 50) -> bool:
+        return await self.clients[0].check_private_link(link, min_participants)
+
+    async def check_public_link(self, link: str, min_participants: int = 50) -> bool:
+        return await self.clients[0].check_public_link(link, min_participants)
+
+
+def init_client() -> TelegramClient:
+    """
+    Create the client of the sessions listed in the config, or of the single
+    session if there's no list.
+    """
+
+    sessions = config.get("sessions") or [config["session"]]
+    if len(sessions) == 1:
+        return AsyncTelegramClient(sessions[0])
+
+    return ClientPool(sessions)
@@ -5,11 +5,15 @@ import yaml
 
 BATCH_SIZE = 500
 
-# Sleep delays between requests
+# Initial delays between requests, adjusted by the client's rate limiters
 HISTORY_DELAY = 1.0
 MEDIA_DELAY = 3.0
 CHAT_DELAY = 1.5
 
+# Parts of large documents have their own limiter, so that a large document
+# doesn't use up the requests of the small files
+MEDIA_PART_DELAY = 0.1
+
 
 class TqdmLoggingHandler(logging.Handler):
     """Redirect all logging messages through tqdm.write()"""
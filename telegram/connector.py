@@ -1,29 +1,40 @@
 from sqlalchemy import create_engine, engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 
 from .common import config
+from .serialize import dumps
+
+
+def _tcp_url(drivername: str) -> engine.URL:
+    return engine.URL.create(
+        drivername=drivername,
+        username=config["db_user"],
+        password=config["db_pass"],
+        database=config["db_name"],
+        host=config.get("db_host") or "localhost",
+        port=config.get("db_port") or 5432,
+    )
 
 
 def connect_with_tcp(db_config: dict = {}) -> engine.base.Engine:
-    pool = create_engine(
-        engine.URL.create(
-            drivername="postgresql",
-            username=config["db_user"],
-            password=config["db_pass"],
-            database=config["db_name"],
-            host=config.get("db_host") or "localhost",
-            port=config.get("db_port") or 5432,
-        ),
-        **db_config
+    pool = create_engine(_tcp_url("postgresql"), json_serializer=dumps, **db_config)
+
+    return pool
+
+
+def connect_with_tcp_async(db_config: dict = {}) -> AsyncEngine:
+    pool = create_async_engine(
+        _tcp_url("postgresql+asyncpg"), json_serializer=dumps, **db_config
     )
 
     return pool
 
 
-def init_connection_engine(method: str = "tcp", **kwargs) -> engine.base.Engine:
+def _pool_config(**kwargs) -> dict:
     pool_size = kwargs.get("pool_size")
     pool_timeout = kwargs.get("pool_timeout")
 
-    db_config = {
+    return {
         # Pool size is the maximum number of permanent connections to keep.
         "pool_size": pool_size or 5,
         # Temporarily exceeds the set pool_size if no connections are available.
@@ -40,8 +51,22 @@ def init_connection_engine(method: str = "tcp", **kwargs) -> engine.base.Engine:
         "pool_recycle": 1800,  # 30 minutes
     }
 
+
+def init_connection_engine(method: str = "tcp", **kwargs) -> engine.base.Engine:
+    db_config = _pool_config(**kwargs)
+
     match method:
         case "tcp":
             return connect_with_tcp(db_config)
         case _:
             raise ValueError('Use "tcp" for method as currently supported method')
+
+
+def init_async_connection_engine(method: str = "tcp", **kwargs) -> AsyncEngine:
+    db_config = _pool_config(**kwargs)
+
+    match method:
+        case "tcp":
+            return connect_with_tcp_async(db_config)
+        case _:
+            raise ValueError('Use "tcp" for method as currently supported method')
@@ -1,13 +1,81 @@
+import asyncio
+import functools
+import io
 from abc import ABC, abstractmethod
-from typing import Any, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from sqlalchemy import delete, func, select
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import (
+    BigInteger,
+    Table,
+    UniqueConstraint,
+    bindparam,
+    case,
+    delete,
+    func,
+    literal,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession, async_scoped_session
 from sqlalchemy.orm import Session, aliased
+from sqlalchemy.util import await_only
 
-from .common import logger
-from .connector import init_connection_engine
-from .models import Channel, Message, ResumeMedia, User, UserChannel
+from .common import config, logger
+from .connector import init_async_connection_engine, init_connection_engine
+from .models import (
+    BackfillRange,
+    Channel,
+    ChannelSnapshot,
+    Lease,
+    Media,
+    MediaJob,
+    Message,
+    User,
+    UserChannel,
+)
+
+# Columns refreshed when an already stored record is fetched again. Records are
+# matched on the unique constraint of their table.
+UPSERT_COLUMNS = {
+    "messages": ["data", "message", "views", "forwards"],
+    "media": ["dc_id", "access_hash", "mime_type", "type", "size"],
+    "users": [
+        "username",
+        "first_name",
+        "last_name",
+        "phone",
+        "verified",
+        "restricted",
+        "scam",
+        "fake",
+    ],
+}
+
+
+def _copy_value(value: Any) -> str:
+    """
+    Format a value as a field of PostgreSQL's COPY text format.
+    """
+
+    if value is None:
+        return "\\N"
+    elif isinstance(value, bool):
+        return "t" if value else "f"
+    elif isinstance(value, datetime):
+        return value.isoformat()
+
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+        .replace("\t", "\\t")
+    )
 
 
 class Database(ABC):
@@ -26,7 +94,7 @@ class Database(ABC):
         pass
 
     @abstractmethod
-    def insert_resume_media(self, resume_media: list) -> None:
+    def insert_media_jobs(self, jobs: list) -> None:
         pass
 
     @abstractmethod
@@ -37,24 +105,65 @@ class Database(ABC):
     def insert_users_channels(self, users_channels: list) -> None:
         pass
 
+    @abstractmethod
+    def get_channel_users(self, channel_id: int) -> Dict[int, tuple]:
+        pass
+
+    @abstractmethod
+    def set_users_left(self, channel_id: int, user_ids: List[int], left: bool) -> None:
+        pass
+
     @abstractmethod
     def upsert_channel(self, channel) -> None:
         pass
 
     @abstractmethod
-    def upsert_channel_data(self, channel_id: int, data) -> None:
+    def upsert_channel_data(self, channel_id: int, data) -> bool:
+        pass
+
+    @abstractmethod
+    def get_channel_data_age(self, channel_id: int) -> Optional[float]:
         pass
 
     @abstractmethod
     def get_channel_by_id(self, channel_id: int) -> Any:
         pass
 
+    @abstractmethod
+    def get_channels(self) -> List[Any]:
+        pass
+
+    @abstractmethod
+    def get_channel_titles(self) -> Dict[str, int]:
+        pass
+
+    @abstractmethod
+    def get_channel_activity(
+        self, channel_id: int, window: float
+    ) -> Tuple[int, Optional[float], Optional[float]]:
+        pass
+
+    @abstractmethod
+    def schedule_channel(
+        self,
+        channel_id: int,
+        message_rate: float,
+        interval: float,
+        is_active: bool,
+        is_complete: bool,
+    ) -> None:
+        pass
+
+    @abstractmethod
+    def get_due_channels(self, channel_ids: List[int]) -> List[int]:
+        pass
+
     @abstractmethod
     def get_max_message_id(self, channel_id: int) -> Optional[int]:
         pass
 
     @abstractmethod
-    def get_all_messages(self, channel_id: Optional[int]) -> List[str]:
+    def get_all_messages(self, channel_id: Optional[int]) -> List[Row]:
         pass
 
     @abstractmethod
@@ -62,11 +171,85 @@ class Database(ABC):
         pass
 
     @abstractmethod
-    def get_resume_media(self, channel_id: int) -> List[str]:
+    def claim_media_jobs(self, channel_id: int) -> List[int]:
+        pass
+
+    @abstractmethod
+    def complete_media_jobs(self, channel_id: int, message_ids: List[int]) -> None:
+        pass
+
+    @abstractmethod
+    def fail_media_jobs(
+        self,
+        channel_id: int,
+        failures: List[Tuple[int, str]],
+        max_attempts: int,
+        retry_delay: float,
+    ) -> None:
+        pass
+
+    @abstractmethod
+    def get_media_job_stats(self) -> Dict[str, Tuple[int, int]]:
+        pass
+
+    @abstractmethod
+    def get_media_after(self, channel_id: int, message_id: int, limit: int) -> List:
+        pass
+
+    @abstractmethod
+    def update_media_checkpoint(self, channel_id: int, message_id: int) -> None:
+        pass
+
+    @abstractmethod
+    def set_media_paths(self, channel_id: int, paths: Dict[int, str]) -> None:
+        pass
+
+    @abstractmethod
+    def insert_backfill_ranges(self, ranges: list) -> None:
+        pass
+
+    @abstractmethod
+    def get_backfill_ranges(self, channel_id: int) -> List[Tuple[int, int, int]]:
+        pass
+
+    @abstractmethod
+    def update_backfill_range(
+        self, channel_id: int, start_id: int, checkpoint_id: int
+    ) -> None:
+        pass
+
+    @abstractmethod
+    def delete_backfill_range(self, channel_id: int, start_id: int) -> None:
+        pass
+
+    @abstractmethod
+    def get_time(self) -> datetime:
+        pass
+
+    @abstractmethod
+    def insert_leases(self, kind: str, keys: List[int]) -> None:
+        pass
+
+    @abstractmethod
+    def claim_lease(
+        self, kind: str, keys: List[int], owner: str, since: datetime, ttl: float
+    ) -> Optional[int]:
+        pass
+
+    @abstractmethod
+    def renew_leases(self, owner: str, ttl: float) -> None:
+        pass
+
+    @abstractmethod
+    def finish_lease(self, kind: str, key: int, owner: str) -> None:
+        pass
+
+    @abstractmethod
+    def free_leases(self, kind: str, owner: str) -> None:
         pass
 
     @abstractmethod
-    def get_users_message_count(self, channel_id: int) -> None:
+    def get_users_message_count(self, channel_id: int) -> List[Row]:
         pass
 
     @abstractmethod
@@ -78,69 +261,383 @@ class Database(ABC):
         pass
 
 
+def _naive_utc(value: Any) -> Any:
+    # Timestamp columns have no time zone, and asyncpg refuses aware datetimes
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return value
+
+
 class PgDatabase(Database):
-    def __init__(self):
-        pool = init_connection_engine(method="tcp")
+    def __init__(
+        self, bulk_insert: Optional[bool] = None, session: Optional[Session] = None
+    ):
+        # An existing session may be given, for instance by AsyncPgDatabase
+        if session is None:
+            pool = init_connection_engine(method="tcp")
+
+            session = Session(pool)
+            session.begin()
+
+        self.session = session
+
+        # Write messages and media with COPY instead of multi-row INSERTs
+        if bulk_insert is None:
+            bulk_insert = config.get("bulk_insert", True)
+        self.bulk_insert = bulk_insert
+
+    def _upsert_records(self, table: Table, records: list) -> None:
+        """
+        Write ORM records into a table in one go. Records that already exist
+        have their mutable columns refreshed instead of failing the batch, so
+        that fetching the same messages twice is harmless.
+        """
+
+        if not records:
+            return
+
+        # Columns with server defaults are left to the database
+        columns = [
+            column
+            for column in table.columns
+            if not column.primary_key and column.server_default is None
+        ]
+        constraint = next(
+            constraint
+            for constraint in table.constraints
+            if isinstance(constraint, UniqueConstraint)
+        )
+        keys = [column.name for column in constraint.columns]
+
+        # Postgres refuses to update the same row twice in a single statement
+        rows = {}
+        for record in records:
+            row = {
+                column.name: _naive_utc(getattr(record, column.name))
+                for column in columns
+            }
+            rows[tuple(row[key] for key in keys)] = row
+
+        if self.bulk_insert:
+            self._copy_rows(table, constraint, columns, list(rows.values()))
+            return
+
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            constraint=constraint,
+            set_={
+                **{
+                    column: statement.excluded[column]
+                    for column in UPSERT_COLUMNS[table.name]
+                },
+                "updated_utc": func.now(),
+            },
+        )
+        self.session.execute(statement, list(rows.values()))
+
+    def _copy_rows(
+        self, table: Table, constraint: UniqueConstraint, columns: list, rows: list
+    ) -> None:
+        names = ", ".join(column.name for column in columns)
+        staging = f"staging_{table.name}"
+
+        connection = self.session.connection()
+        dialect = connection.dialect
+        processors = [column.type.bind_processor(dialect) for column in columns]
+
+        records = []
+        for row in rows:
+            values = []
+            for column, processor in zip(columns, processors):
+                value = row[column.name]
+                if processor is not None and value is not None:
+                    value = processor(value)
+                values.append(value)
+            records.append(values)
+
+        # COPY can't handle conflicting rows, so they go through a temporary table
+        connection.exec_driver_sql(
+            f"CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DELETE ROWS "
+            f"AS SELECT {names} FROM {table.name} WITH NO DATA"
+        )
+        connection.exec_driver_sql(f"TRUNCATE {staging}")
+
+        driver_connection = connection.connection.driver_connection
+        if hasattr(driver_connection, "copy_records_to_table"):
+            # asyncpg, from within AsyncSession.run_sync
+            await_only(
+                driver_connection.copy_records_to_table(
+                    staging,
+                    records=records,
+                    columns=[column.name for column in columns],
+                )
+            )
+        else:
+            buffer = io.StringIO()
+            for values in records:
+                buffer.write("\t".join(_copy_value(value) for value in values) + "\n")
+            buffer.seek(0)
 
-        self.session = Session(pool)
-        self.session.begin()
+            cursor = driver_connection.cursor()
+            cursor.copy_expert(f"COPY {staging} ({names}) FROM STDIN", buffer)
+            cursor.close()
+
+        # The constraint may be unnamed, like the one of users.user_id
+        keys = ", ".join(column.name for column in constraint.columns)
+        updates = ", ".join(
+            f"{column} = EXCLUDED.{column}" for column in UPSERT_COLUMNS[table.name]
+        )
+        connection.exec_driver_sql(
+            f"INSERT INTO {table.name} ({names}) SELECT {names} FROM {staging} "
+            f"ON CONFLICT ({keys}) "
+            f"DO UPDATE SET {updates}, updated_utc = now()"
+        )
 
     def insert_messages(self, messages: list) -> None:
-        self.session.add_all(messages)
+        self._upsert_records(Message.__table__, messages)
 
     def insert_media(self, media: list) -> None:
-        self.session.add_all(media)
+        self._upsert_records(Media.__table__, media)
 
-    def insert_resume_media(self, resume_media: list) -> None:
-        self.session.add_all(resume_media)
+    def insert_media_jobs(self, jobs: list) -> None:
+        if not jobs:
+            return
+
+        statement = insert(MediaJob).on_conflict_do_nothing(
+            constraint="uq_media_jobs_channel_id_message_id"
+        )
+        rows = [
+            dict(
+                channel_id=job.channel_id,
+                message_id=job.message_id,
+                media_id=job.media_id,
+                size=job.size,
+                priority=job.priority,
+            )
+            for job in jobs
+        ]
+        self.session.execute(statement, rows)
 
     def insert_users(self, users: list) -> None:
-        # Don't add duplicate users
-        existing = self.session.execute(select(User.user_id)).scalars().all()
-        users = [user for user in users if user.user_id not in existing]
-        self.session.add_all(users)
+        self._upsert_records(User.__table__, users)
 
     def insert_users_channels(self, users_channels: list) -> None:
-        # Don't add duplicate relations
-        existing = self.session.execute(
-            select(UserChannel.channel_id, UserChannel.user_id)
-        ).all()
-        users_channels = [
-            uc for uc in users_channels if (uc.channel_id, uc.user_id) not in existing
+        if not users_channels:
+            return
+
+        # Relations that already exist are left as they are
+        statement = insert(UserChannel).on_conflict_do_nothing(
+            constraint="uq_users_channels_user_id_channel_id"
+        )
+        rows = [
+            dict(channel_id=uc.channel_id, user_id=uc.user_id) for uc in users_channels
         ]
+        self.session.execute(statement, rows)
 
-        self.session.add_all(users_channels)
+    def get_channel_users(self, channel_id: int) -> Dict[int, tuple]:
+        """
+        Get the users still in a channel, along with their mutable columns.
+        """
 
-    def upsert_channel(self, channel) -> None:
+        columns = [getattr(User, column) for column in UPSERT_COLUMNS["users"]]
         statement = (
-            insert(Channel)
-            .values(
-                channel_id=channel.channel_id,
-                name=channel.name,
-                max_message_id=channel.max_message_id,
-            )
-            .on_conflict_do_update(
-                index_elements=["channel_id"],
-                set_=dict(max_message_id=channel.max_message_id),
+            select(User.user_id, *columns)
+            .join(UserChannel, UserChannel.user_id == User.user_id)
+            .filter(UserChannel.channel_id == channel_id)
+            .filter(UserChannel.left_utc.is_(None))
+        )
+
+        return {
+            user_id: tuple(values)
+            for user_id, *values in self.session.execute(statement)
+        }
+
+    def set_users_left(self, channel_id: int, user_ids: List[int], left: bool) -> None:
+        if not user_ids:
+            return
+
+        statement = (
+            update(UserChannel)
+            .filter(
+                UserChannel.channel_id == channel_id,
+                UserChannel.user_id.in_(user_ids),
             )
+            .values(left_utc=func.now() if left else None)
+            .execution_options(synchronize_session=False)
         )
 
         self.session.execute(statement)
 
-    def upsert_channel_data(self, channel_id: int, data) -> None:
-        pass
+    def upsert_channel(self, channel) -> None:
+        statement = insert(Channel).values(
+            channel_id=channel.channel_id,
+            name=channel.name,
+            max_message_id=channel.max_message_id,
+        )
+        # Writers racing on the same channel never move its last message back
+        statement = statement.on_conflict_do_update(
+            index_elements=["channel_id"],
+            set_=dict(
+                max_message_id=func.greatest(
+                    Channel.max_message_id, statement.excluded.max_message_id
+                )
+            ),
+        )
+
+        self.session.execute(statement)
+
+    def upsert_channel_data(self, channel_id: int, data) -> bool:
+        """
+        Store the full info of a channel as a new snapshot if it changed since
+        the latest one, and return whether it did.
+        """
+
+        snapshot = ChannelSnapshot(channel_id, data)
+        latest = self.session.execute(
+            select(ChannelSnapshot.id, ChannelSnapshot.content_hash)
+            .filter_by(channel_id=channel_id)
+            .order_by(ChannelSnapshot.id.desc())
+            .limit(1)
+        ).first()
+
+        if latest is not None and latest.content_hash == snapshot.content_hash:
+            self.session.execute(
+                update(ChannelSnapshot)
+                .filter_by(id=latest.id)
+                .values(checked_utc=func.now())
+                .execution_options(synchronize_session=False)
+            )
+            return False
+
+        self.session.add(snapshot)
+        return True
+
+    def get_channel_data_age(self, channel_id: int) -> Optional[float]:
+        """
+        Get the seconds since the full info of a channel was last fetched.
+        """
+
+        statement = select(
+            func.extract("epoch", func.now() - func.max(ChannelSnapshot.checked_utc))
+        ).filter(ChannelSnapshot.channel_id == channel_id)
+
+        age = self.session.execute(statement).scalar()
+        return float(age) if age is not None else None
 
     def get_channel_by_id(self, channel_id: int) -> Optional[Channel]:
         statement = select(Channel).filter_by(channel_id=channel_id)
 
         return self.session.execute(statement).scalars().first()
 
+    def get_channels(self) -> List[Channel]:
+        statement = select(Channel).order_by(Channel.next_poll_utc, Channel.name)
+
+        return self.session.execute(statement).scalars().all()
+
+    def get_channel_titles(self) -> Dict[str, int]:
+        """
+        Map the names of the channels, and the titles found in their snapshots
+        (which catch renames), to their ids.
+        """
+
+        titles = {}
+
+        statement = select(
+            ChannelSnapshot.channel_id,
+            ChannelSnapshot.data["full_chat"]["id"],
+            ChannelSnapshot.data["chats"],
+        )
+        for channel_id, chat_id, chats in self.session.execute(statement):
+            for chat in chats or []:
+                if chat.get("id") == chat_id and chat.get("title"):
+                    titles[chat["title"]] = channel_id
+
+        for channel_id, name in self.session.execute(
+            select(Channel.channel_id, Channel.name)
+        ):
+            titles[name] = channel_id
+
+        return titles
+
+    def get_channel_activity(
+        self, channel_id: int, window: float, limit: int = 10000
+    ) -> Tuple[int, Optional[float], Optional[float]]:
+        """
+        Count the messages of a channel sent in the last window seconds, among
+        its latest limit messages, and get the seconds since the latest and
+        the oldest of these.
+        """
+
+        # Message dates are stored in UTC
+        now = func.timezone("UTC", func.now())
+        latest = (
+            select(Message.message_utc)
+            .filter(Message.channel_id == channel_id)
+            .order_by(Message.message_id.desc())
+            .limit(limit)
+            .subquery()
+        )
+        statement = select(
+            func.count().filter(
+                latest.c.message_utc >= now - timedelta(seconds=window)
+            ),
+            func.extract("epoch", now - func.max(latest.c.message_utc)),
+            func.extract("epoch", now - func.min(latest.c.message_utc)),
+        )
+
+        recent, idle, age = self.session.execute(statement).one()
+        return (
+            recent,
+            float(idle) if idle is not None else None,
+            float(age) if age is not None else None,
+        )
+
+    def schedule_channel(
+        self,
+        channel_id: int,
+        message_rate: float,
+        interval: float,
+        is_active: bool,
+        is_complete: bool,
+    ) -> None:
+        statement = (
+            update(Channel)
+            .filter_by(channel_id=channel_id)
+            .values(
+                message_rate=message_rate,
+                next_poll_utc=func.now() + timedelta(seconds=interval),
+                is_active=is_active,
+                is_complete=is_complete,
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+        self.session.execute(statement)
+
+    def get_due_channels(self, channel_ids: List[int]) -> List[int]:
+        """
+        Get which of the channels should be polled now: the ones never polled,
+        the ones whose history isn't complete and the ones past their time.
+        """
+
+        statement = select(Channel.channel_id).filter(
+            Channel.channel_id.in_(channel_ids),
+            or_(
+                Channel.next_poll_utc.is_(None),
+                Channel.next_poll_utc <= func.now(),
+                Channel.is_complete.is_(False),
+            ),
+        )
+
+        return self.session.execute(statement).scalars().all()
+
     def get_max_message_id(self, channel_id: int) -> Optional[int]:
         statement = select(Channel.max_message_id).filter_by(channel_id=channel_id)
 
         return self.session.execute(statement).scalars().first()
 
-    def get_all_messages(self, channel_id: Optional[int]) -> List[str]:
+    def get_all_messages(self, channel_id: Optional[int]) -> List[Row]:
         statement = select(Message.id, Message.message, Message.message_utc).filter(
             Message.message_utc.isnot(None)
         )
@@ -157,15 +654,270 @@ class PgDatabase(Database):
 
         return self.session.execute(statement).scalars().all()
 
-    def get_resume_media(self, channel_id: int) -> List[str]:
-        statement = select(ResumeMedia.data).filter_by(channel_id=channel_id)
-        resume_media = self.session.execute(statement).scalars().all()
+    def claim_media_jobs(self, channel_id: int) -> List[int]:
+        """
+        Take the jobs of a channel that are pending, or failed and due for
+        another attempt, back to pending. Returns their message IDs.
+        """
 
-        self.session.execute(delete(ResumeMedia).filter_by(channel_id=channel_id))
+        statement = (
+            update(MediaJob)
+            .filter(
+                MediaJob.channel_id == channel_id,
+                MediaJob.state.in_(["pending", "failed"]),
+                or_(
+                    MediaJob.next_attempt_utc.is_(None),
+                    MediaJob.next_attempt_utc <= func.now(),
+                ),
+            )
+            .values(state="pending", next_attempt_utc=None)
+            .returning(MediaJob.message_id)
+            .execution_options(synchronize_session=False)
+        )
+
+        return sorted(self.session.execute(statement).scalars().all())
+
+    def complete_media_jobs(self, channel_id: int, message_ids: List[int]) -> None:
+        if not message_ids:
+            return
+
+        statement = delete(MediaJob).filter(
+            MediaJob.channel_id == channel_id, MediaJob.message_id.in_(message_ids)
+        )
+
+        self.session.execute(statement)
+
+    def fail_media_jobs(
+        self,
+        channel_id: int,
+        failures: List[Tuple[int, str]],
+        max_attempts: int,
+        retry_delay: float,
+    ) -> None:
+        """
+        Record failed attempts at jobs, given with their error. Each job is
+        tried again after retry_delay seconds, doubled with every attempt, or
+        left dead after max_attempts attempts.
+        """
+
+        if not failures:
+            return
+
+        table = MediaJob.__table__
+        delay = func.make_interval(
+            0, 0, 0, 0, 0, 0, retry_delay * func.power(2, table.c.attempts)
+        )
+        statement = (
+            update(table)
+            .where(
+                table.c.channel_id == channel_id,
+                table.c.message_id == bindparam("b_message_id"),
+            )
+            .values(
+                attempts=table.c.attempts + 1,
+                last_error=bindparam("b_error"),
+                state=case(
+                    (table.c.attempts + 1 >= max_attempts, "dead"), else_="failed"
+                ),
+                next_attempt_utc=func.now() + delay,
+                updated_utc=func.now(),
+            )
+        )
+        rows = [
+            dict(b_message_id=message_id, b_error=error)
+            for message_id, error in failures
+        ]
+
+        self.session.execute(statement, rows)
+
+    def get_media_job_stats(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Count the media jobs, and sum the bytes of their media, by state.
+        """
+
+        statement = select(
+            MediaJob.state, func.count(), func.coalesce(func.sum(MediaJob.size), 0)
+        ).group_by(MediaJob.state)
+
+        return {
+            state: (count, int(size))
+            for state, count, size in self.session.execute(statement)
+        }
+
+    def get_media_after(self, channel_id: int, message_id: int, limit: int) -> List:
+        statement = (
+            select(Media)
+            .filter(Media.channel_id == channel_id, Media.message_id > message_id)
+            .order_by(Media.message_id)
+            .limit(limit)
+        )
+
+        return self.session.execute(statement).scalars().all()
+
+    def update_media_checkpoint(self, channel_id: int, message_id: int) -> None:
+        statement = (
+            update(Channel)
+            .filter_by(channel_id=channel_id)
+            .values(media_checkpoint_id=message_id)
+        )
+
+        self.session.execute(statement)
+
+    def set_media_paths(self, channel_id: int, paths: Dict[int, str]) -> None:
+        """
+        Record where the media of messages, given by message id, is stored.
+        """
+
+        if not paths:
+            return
+
+        table = Media.__table__
+        statement = (
+            update(table)
+            .where(
+                table.c.channel_id == channel_id,
+                table.c.message_id == bindparam("b_message_id"),
+            )
+            .values(local_path=bindparam("b_local_path"))
+        )
+        rows = [
+            dict(b_message_id=message_id, b_local_path=path)
+            for message_id, path in paths.items()
+        ]
+
+        self.session.execute(statement, rows)
+
+    def insert_backfill_ranges(self, ranges: list) -> None:
+        self.session.add_all(ranges)
+
+    def get_backfill_ranges(self, channel_id: int) -> List[Tuple[int, int, int]]:
+        """
+        Return (start_id, checkpoint_id, end_id) of the ranges left to fetch.
+        """
+
+        statement = (
+            select(
+                BackfillRange.start_id,
+                BackfillRange.checkpoint_id,
+                BackfillRange.end_id,
+            )
+            .filter_by(channel_id=channel_id)
+            .order_by(BackfillRange.start_id)
+        )
+
+        return [
+            (row.start_id, row.checkpoint_id, row.end_id)
+            for row in self.session.execute(statement)
+        ]
+
+    def update_backfill_range(
+        self, channel_id: int, start_id: int, checkpoint_id: int
+    ) -> None:
+        statement = (
+            update(BackfillRange)
+            .filter_by(channel_id=channel_id, start_id=start_id)
+            .values(checkpoint_id=checkpoint_id)
+        )
+
+        self.session.execute(statement)
+
+    def delete_backfill_range(self, channel_id: int, start_id: int) -> None:
+        statement = delete(BackfillRange).filter_by(
+            channel_id=channel_id, start_id=start_id
+        )
+
+        self.session.execute(statement)
+
+    def get_time(self) -> datetime:
+        """
+        Get the time of the database, as stored in its timestamp columns.
+        """
+
+        now = self.session.execute(select(func.localtimestamp())).scalar()
+        if now is None:
+            raise RuntimeError("The database returned no time")
+
+        return now
+
+    def insert_leases(self, kind: str, keys: List[int]) -> None:
+        if not keys:
+            return
+
+        statement = insert(Lease).on_conflict_do_nothing(
+            constraint="uq_leases_kind_key"
+        )
+        self.session.execute(statement, [dict(kind=kind, key=key) for key in keys])
+
+    def claim_lease(
+        self, kind: str, keys: List[int], owner: str, since: datetime, ttl: float
+    ) -> Optional[int]:
+        """
+        Claim the first of the keys (in the given order) that no other worker
+        holds and that wasn't finished since the given time, for ttl seconds.
+        Rows being claimed by other workers are skipped rather than waited on.
+        Returns the claimed key, if any.
+        """
+
+        order = func.array_position(literal(keys, ARRAY(BigInteger)), Lease.key)
+        candidate = (
+            select(Lease.id)
+            .filter(Lease.kind == kind, Lease.key.in_(keys))
+            .filter(or_(Lease.owner.is_(None), Lease.expires_utc < func.now()))
+            .filter(or_(Lease.finished_utc.is_(None), Lease.finished_utc < since))
+            .order_by(order)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        statement = (
+            update(Lease)
+            .where(Lease.id == candidate)
+            .values(
+                owner=owner,
+                acquired_utc=func.now(),
+                expires_utc=func.now() + timedelta(seconds=ttl),
+            )
+            .returning(Lease.key)
+            .execution_options(synchronize_session=False)
+        )
+
+        return self.session.execute(statement).scalar()
 
-        return resume_media
+    def renew_leases(self, owner: str, ttl: float) -> None:
+        statement = (
+            update(Lease)
+            .filter(Lease.owner == owner)
+            .values(expires_utc=func.now() + timedelta(seconds=ttl))
+            .execution_options(synchronize_session=False)
+        )
 
-    def get_users_message_count(self, channel_id: int) -> None:
+        self.session.execute(statement)
+
+    def finish_lease(self, kind: str, key: int, owner: str) -> None:
+        statement = (
+            update(Lease)
+            .filter_by(kind=kind, key=key, owner=owner)
+            .values(owner=None, expires_utc=None, finished_utc=func.now())
+            .execution_options(synchronize_session=False)
+        )
+
+        self.session.execute(statement)
+
+    def free_leases(self, kind: str, owner: str) -> None:
+        """
+        Give back the leases left by a previous run of the same worker.
+        """
+
+        statement = (
+            update(Lease)
+            .filter_by(kind=kind, owner=owner)
+            .values(owner=None, expires_utc=None)
+            .execution_options(synchronize_session=False)
+        )
+
+        self.session.execute(statement)
+
+    def get_users_message_count(self, channel_id: int) -> List[Row]:
         users_from_channel = (
             select(User)
             .join(UserChannel)
@@ -220,3 +972,253 @@ class PgDatabase(Database):
             logger.error(f"Failed to flush. Error: {e}.")
             self.session.rollback()
             raise e
+
+
+class AsyncDatabase(ABC):
+    """
+    Asynchronous counterpart of Database, awaited by the downloader and the searcher.
+    Every method runs the PgDatabase method of the same name.
+    """
+
+    @abstractmethod
+    async def _run(self, method: str, *args) -> Any:
+        pass
+
+    async def release(self) -> None:
+        """
+        Give back the resources held for the current task.
+        """
+
+    async def insert_messages(self, messages: list) -> None:
+        await self._run("insert_messages", messages)
+
+    async def insert_media(self, media: list) -> None:
+        await self._run("insert_media", media)
+
+    async def insert_media_jobs(self, jobs: list) -> None:
+        await self._run("insert_media_jobs", jobs)
+
+    async def insert_users(self, users: list) -> None:
+        await self._run("insert_users", users)
+
+    async def insert_users_channels(self, users_channels: list) -> None:
+        await self._run("insert_users_channels", users_channels)
+
+    async def get_channel_users(self, channel_id: int) -> Dict[int, tuple]:
+        return await self._run("get_channel_users", channel_id)
+
+    async def set_users_left(
+        self, channel_id: int, user_ids: List[int], left: bool
+    ) -> None:
+        await self._run("set_users_left", channel_id, user_ids, left)
+
+    async def upsert_channel(self, channel) -> None:
+        await self._run("upsert_channel", channel)
+
+    async def upsert_channel_data(self, channel_id: int, data) -> bool:
+        return await self._run("upsert_channel_data", channel_id, data)
+
+    async def get_channel_data_age(self, channel_id: int) -> Optional[float]:
+        return await self._run("get_channel_data_age", channel_id)
+
+    async def get_channel_by_id(self, channel_id: int) -> Optional[Channel]:
+        return await self._run("get_channel_by_id", channel_id)
+
+    async def get_channels(self) -> List[Channel]:
+        return await self._run("get_channels")
+
+    async def get_channel_activity(
+        self, channel_id: int, window: float
+    ) -> Tuple[int, Optional[float], Optional[float]]:
+        return await self._run("get_channel_activity", channel_id, window)
+
+    async def schedule_channel(
+        self,
+        channel_id: int,
+        message_rate: float,
+        interval: float,
+        is_active: bool,
+        is_complete: bool,
+    ) -> None:
+        await self._run(
+            "schedule_channel",
+            channel_id,
+            message_rate,
+            interval,
+            is_active,
+            is_complete,
+        )
+
+    async def get_due_channels(self, channel_ids: List[int]) -> List[int]:
+        return await self._run("get_due_channels", channel_ids)
+
+    async def get_max_message_id(self, channel_id: int) -> Optional[int]:
+        return await self._run("get_max_message_id", channel_id)
+
+    async def get_all_messages(self, channel_id: Optional[int]) -> List[Row]:
+        return await self._run("get_all_messages", channel_id)
+
+    async def get_messages_with_pattern(self, pattern: str) -> List[str]:
+        return await self._run("get_messages_with_pattern", pattern)
+
+    async def claim_media_jobs(self, channel_id: int) -> List[int]:
+        return await self._run("claim_media_jobs", channel_id)
+
+    async def complete_media_jobs(
+        self, channel_id: int, message_ids: List[int]
+    ) -> None:
+        await self._run("complete_media_jobs", channel_id, message_ids)
+
+    async def fail_media_jobs(
+        self,
+        channel_id: int,
+        failures: List[Tuple[int, str]],
+        max_attempts: int,
+        retry_delay: float,
+    ) -> None:
+        await self._run(
+            "fail_media_jobs", channel_id, failures, max_attempts, retry_delay
+        )
+
+    async def get_media_job_stats(self) -> Dict[str, Tuple[int, int]]:
+        return await self._run("get_media_job_stats")
+
+    async def get_media_after(
+        self, channel_id: int, message_id: int, limit: int
+    ) -> List:
+        return await self._run("get_media_after", channel_id, message_id, limit)
+
+    async def update_media_checkpoint(self, channel_id: int, message_id: int) -> None:
+        await self._run("update_media_checkpoint", channel_id, message_id)
+
+    async def set_media_paths(self, channel_id: int, paths: Dict[int, str]) -> None:
+        await self._run("set_media_paths", channel_id, paths)
+
+    async def insert_backfill_ranges(self, ranges: list) -> None:
+        await self._run("insert_backfill_ranges", ranges)
+
+    async def get_backfill_ranges(self, channel_id: int) -> List[Tuple[int, int, int]]:
+        return await self._run("get_backfill_ranges", channel_id)
+
+    async def update_backfill_range(
+        self, channel_id: int, start_id: int, checkpoint_id: int
+    ) -> None:
+        await self._run("update_backfill_range", channel_id, start_id, checkpoint_id)
+
+    async def delete_backfill_range(self, channel_id: int, start_id: int) -> None:
+        await self._run("delete_backfill_range", channel_id, start_id)
+
+    async def get_time(self) -> datetime:
+        return await self._run("get_time")
+
+    async def insert_leases(self, kind: str, keys: List[int]) -> None:
+        await self._run("insert_leases", kind, keys)
+
+    async def claim_lease(
+        self, kind: str, keys: List[int], owner: str, since: datetime, ttl: float
+    ) -> Optional[int]:
+        return await self._run("claim_lease", kind, keys, owner, since, ttl)
+
+    async def renew_leases(self, owner: str, ttl: float) -> None:
+        await self._run("renew_leases", owner, ttl)
+
+    async def finish_lease(self, kind: str, key: int, owner: str) -> None:
+        await self._run("finish_lease", kind, key, owner)
+
+    async def free_leases(self, kind: str, owner: str) -> None:
+        await self._run("free_leases", kind, owner)
+
+    async def get_users_message_count(self, channel_id: int) -> List[Row]:
+        return await self._run("get_users_message_count", channel_id)
+
+    async def commit_changes(self) -> None:
+        await self._run("commit_changes")
+
+    async def flush_changes(self) -> None:
+        await self._run("flush_changes")
+
+
+class AsyncPgDatabase(AsyncDatabase):
+    """
+    Runs the queries on asyncpg connections. Each task gets its own session, so
+    concurrent dialogs don't share a transaction; tasks call release() when done.
+    """
+
+    def __init__(self, pool_size: Optional[int] = None):
+        self.bulk_insert = config.get("bulk_insert", True)
+
+        pool = init_async_connection_engine(method="tcp", pool_size=pool_size)
+        factory = functools.partial(AsyncSession, pool, expire_on_commit=False)
+
+        self.session = async_scoped_session(factory, scopefunc=asyncio.current_task)
+
+    async def _run(self, method: str, *args) -> Any:
+        def run(session: Session) -> Any:
+            database = PgDatabase(bulk_insert=self.bulk_insert, session=session)
+            return getattr(database, method)(*args)
+
+        return await self.session().run_sync(run)
+
+    async def release(self) -> None:
+        await self.session.remove()
+
+
+class ThreadedDatabase(AsyncDatabase):
+    """
+    Runs psycopg2 PgDatabases in worker threads, so queries don't block the event
+    loop. As with AsyncPgDatabase, each task gets its own session, so concurrent
+    dialogs don't share a transaction; tasks call release() when done.
+    """
+
+    def __init__(self, pool_size: Optional[int] = None):
+        self.bulk_insert = config.get("bulk_insert", True)
+        self.pool = init_connection_engine(method="tcp", pool_size=pool_size)
+
+        # A thread for each connection, so that a query waiting for a lock held
+        # by another session doesn't keep that session from releasing it
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.databases: Dict[Optional[asyncio.Task], PgDatabase] = {}
+
+    def _database(self) -> PgDatabase:
+        task = asyncio.current_task()
+        if task not in self.databases:
+            session = Session(self.pool)
+            session.begin()
+
+            self.databases[task] = PgDatabase(self.bulk_insert, session=session)
+
+        return self.databases[task]
+
+    async def _run(self, method: str, *args) -> Any:
+        function: Callable = getattr(self._database(), method)
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def release(self) -> None:
+        database = self.databases.pop(asyncio.current_task(), None)
+        if database is not None:
+            # Rolls back what wasn't committed and returns the connection
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, database.session.close)
+
+
+def init_async_database(concurrency: int = 1) -> AsyncDatabase:
+    """
+    Create the database selected by the db_driver setting, with enough
+    connections for the dialogs downloaded concurrently.
+    """
+
+    driver = config.get("db_driver") or "asyncpg"
+
+    # Each dialog holds a connection for its reads and one for its writes, and
+    # the lease heartbeat one of its own
+    pool_size = 2 * concurrency + 2
+
+    match driver:
+        case "asyncpg":
+            return AsyncPgDatabase(pool_size=pool_size)
+        case "psycopg2":
+            return ThreadedDatabase(pool_size=pool_size)
+        case _:
+            raise ValueError('Use "asyncpg" or "psycopg2" for db_driver')
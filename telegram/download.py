@@ -1,31 +1,108 @@
 import asyncio
-import json
+import itertools
 import os
-import time
-from typing import Any, List
+import socket
+from collections import defaultdict
+from contextlib import suppress
+from datetime import datetime
+from typing import Any, Callable, DefaultDict, Dict, List, Optional, Set, Tuple
 
+from telethon import errors
 from telethon.tl import types
 from tqdm import tqdm
 
 from .client import TelegramClient
-from .common import BATCH_SIZE, HISTORY_DELAY, MEDIA_DELAY, config, logger
-from .database import Database
-from .models import Channel, Media, Message, ResumeMedia, User, UserChannel
+from .common import BATCH_SIZE, config, logger
+from .database import UPSERT_COLUMNS, AsyncDatabase
+from .media import MediaItem
+from .models import (
+    BackfillRange,
+    Channel,
+    Media,
+    MediaJob,
+    Message,
+    User,
+    UserChannel,
+)
+from .pipeline import StageCounter
+from .policy import MediaDecision, MediaPolicy
+from .schedule import PollSchedule
+from .storage import (
+    DOWNLOAD_FOLDER,
+    MediaKey,
+    MediaStore,
+    PartialFile,
+    media_key,
+    media_path,
+)
 
 BAR_FORMAT = (
     "{l_bar}{bar}| {n_fmt}/{total_fmt} "
     "[{elapsed}<{remaining}, {rate_noinv_fmt}{postfix}]"
 )
-DOWNLOAD_PART_SIZE = 256 * 1024
+
+# Large documents are downloaded in parts of this size, which resume on the
+# next attempt when interrupted. Telegram serves at most 1MB at a time, and
+# parts must not cross a 1MB boundary.
+DOWNLOAD_PART_SIZE = 1024 * 1024
+
+# Batches of messages each stage of the ingestion can get ahead of the next one
+PIPELINE_DEPTH = 2
+
+# Files from this size on are considered large
+LARGE_MEDIA_SIZE = 20 * 1024 * 1024
+
+# Seconds between deletions of the media jobs done, while waiting for media
+JOB_FLUSH_INTERVAL = 10.0
+
+# Kind of the lease a worker holds over the media jobs of a dialog, shared by
+# every job that downloads media
+MEDIA_LEASE = "media"
+
+# Smallest number of message IDs worth a backfill range of its own
+MIN_RANGE_SIZE = 10 * BATCH_SIZE
+
+# Media a dialog can have queued for download. Past that, writing messages
+# waits for the media workers, which in turn holds up fetching
+MEDIA_QUEUE_DEPTH = 2 * BATCH_SIZE
+
+
+def _user_values(record: User) -> tuple:
+    # Mutable columns of a user, as returned by get_channel_users
+    return tuple(getattr(record, column) for column in UPSERT_COLUMNS["users"])
+
+
+class DialogContext:
+    """
+    State of a single dialog dump. Kept apart from the Downloader so that
+    several dialogs can be dumped concurrently.
+    """
+
+    def __init__(self, dialog: types.Dialog) -> None:
+        self.dialog = dialog
+        self.bar: Optional[tqdm] = None
+
+        # Media is downloaded by priority, then smallest first
+        self.media_queue: asyncio.PriorityQueue[Any] = asyncio.PriorityQueue(
+            maxsize=MEDIA_QUEUE_DEPTH
+        )
+        self.sequence = itertools.count()
+
+        # IDs of the messages whose media is done, but still has a job, and
+        # of the ones whose media failed, with their error
+        self.completed: List[int] = []
+        self.failed: List[Tuple[int, str]] = []
+
+        self.running = False
 
 
 class Downloader:
     """
     Download dialogs and their associated data, and dump them.
-    Make Telegram API requests and sleep for the appropriate time.
+    Make Telegram API requests, paced by the client's rate limiters.
     """
 
-    def __init__(self, args, client: TelegramClient, db: Database) -> None:
+    def __init__(self, args, client: TelegramClient, db: AsyncDatabase) -> None:
         self.db = db
         self.client = client
         self.whitelist = config.get("whitelist")
@@ -34,11 +111,60 @@ class Downloader:
         # Check if media should be downloaded or not
         self.with_media = not args.without_media
 
-        # We're gonna need a few queues if we want to do things concurrently.
-        # None values should be inserted to notify that the dump has finished.
-        self._media_queue: asyncio.Queue[Any] = asyncio.Queue()
+        # Number of dialogs dumped at the same time
+        self.concurrency = max(args.concurrency, 1)
 
-        self._running = False
+        # Number of message ID ranges of a dialog fetched at the same time
+        self.backfill_ranges = max(args.backfill_ranges, 1)
+
+        # Number of media downloaded at the same time for each dialog. Limits
+        # are shared by all dialogs, so that no data center gets too many
+        # downloads and large files leave room for the small ones.
+        self.media_workers = max(args.media_workers, 1)
+        self._dc_downloads: DefaultDict[int, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(config.get("max_downloads_per_dc", 4))
+        )
+        self._large_downloads = asyncio.Semaphore(config.get("max_large_downloads", 2))
+
+        # Number of parts of a large document downloaded at the same time
+        self.part_workers = max(config.get("media_part_workers", 1), 1)
+
+        # Media that fails is tried again media_retry_delay seconds later, a
+        # delay doubled with each attempt, up to media_max_attempts attempts
+        self.media_max_attempts = config.get("media_max_attempts", 5)
+        self.media_retry_delay = config.get("media_retry_delay", 60)
+
+        # Throughput of each ingestion stage, over all dialogs
+        self.counters = {
+            name: StageCounter(name) for name in ["fetch", "transform", "write"]
+        }
+
+        # Live ingestion: how long new messages may wait to be written in a
+        # single batch, and how often dialogs are checked for missed messages
+        self.follow_latency = config.get("follow_latency", 1.0)
+        self.gap_check_interval = config.get("gap_check_interval", 300)
+        self._followed: Dict[int, types.Dialog] = {}
+
+        # Workers sharing the database lease the dialogs they work on, for
+        # lease_ttl seconds at a time
+        self.worker_id = config.get("worker_id") or socket.gethostname()
+        self.lease_ttl = config.get("lease_ttl", 120)
+
+        # Seconds before the full info of a channel is fetched again
+        self.channel_info_interval = config.get("channel_info_interval", 24 * 3600)
+        self.live_counter = StageCounter("live")
+        self._live_contexts: Dict[int, Tuple[DialogContext, List[asyncio.Future]]] = {}
+
+        # Which media to download, and in which order
+        self.policy = MediaPolicy(config.get("media_policy"))
+
+        # When each dialog is polled for new messages, unless told otherwise
+        self.schedule = PollSchedule(config.get("poll_schedule"))
+        self.ignore_schedule = args.ignore_schedule
+
+        # Media is downloaded once into the store, and linked into dialogs
+        self.store = MediaStore()
+        self._stored_media: Optional[Set[MediaKey]] = None
 
     def _check_media(self, message: types.Message) -> bool:
         if isinstance(message.media, types.MessageMediaDocument) and isinstance(
@@ -53,197 +179,779 @@ class Downloader:
 
         return False
 
-    def _create_download_folder(self, dialog: types.Dialog) -> str:
-        folderpath = os.path.join("downloads", dialog.title)
-        if not os.path.exists(folderpath):
-            os.makedirs(folderpath)
+    async def _fetch_media(self, media: MediaItem, filename: str) -> None:
+        async with self._dc_downloads[media.dc_id]:
+            await self.client.get_media(media=media, filename=filename)
 
-        return folderpath
+    async def _fetch_media_parts(self, media: MediaItem, filename: str) -> None:
+        """
+        Download a document in parts, resuming the parts done by a previous
+        attempt, with up to part_workers parts at the same time.
+        """
+
+        partial = PartialFile(filename, media.size, DOWNLOAD_PART_SIZE)
+
+        async def worker() -> None:
+            while (index := partial.next_part()) is not None:
+                async with self._dc_downloads[media.dc_id]:
+                    data = await self.client.get_media_part(
+                        media, index * DOWNLOAD_PART_SIZE, DOWNLOAD_PART_SIZE
+                    )
+                partial.write(index, data)
+
+        workers = [
+            asyncio.ensure_future(worker())
+            for _ in range(min(self.part_workers, partial.missing))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for part_worker in workers:
+                part_worker.cancel()
+            partial.close()
 
-    async def _download_media(self, message) -> None:
-        filename = os.path.join(self._folderpath, str(message.id))
+        if partial.missing:
+            raise RuntimeError(f"{partial.missing} parts missing from {filename}")
+
+    async def _download_media(self, context: DialogContext, media: MediaItem) -> None:
+        filename = os.path.join(
+            DOWNLOAD_FOLDER, media_path(media.channel_id, media.message_id)
+        )
         if os.path.isfile(filename):
             return
 
-        self._incomplete_download = filename
-        await self.client.get_media(message=message, filename=filename)
-        self._incomplete_download = None  # type: ignore
+        async def download(filename: str) -> None:
+            if media.size >= LARGE_MEDIA_SIZE:
+                async with self._large_downloads:
+                    if media.is_document:
+                        await self._fetch_media_parts(media, filename)
+                    else:
+                        await self._fetch_media(media, filename)
+            else:
+                await self._fetch_media(media, filename)
 
-    async def _media_consumer(self, queue, bar) -> None:
-        while self._running:
-            start = time.time()
+        key = media_key(media.media_id, media.is_document)
+        await self.store.fetch(key, filename, download)
 
-            message = await queue.get()
-            await self._download_media(message)
-            queue.task_done()
-            bar.update(1)
+    async def _media_consumer(self, context: DialogContext) -> None:
+        while context.running:
+            *_, media = await context.media_queue.get()
+            try:
+                await self._download_media(context, media)
+            except Exception as e:
+                logger.warning(
+                    f"Failed to get media from message {media.message_id}: {e}"
+                )
+                context.failed.append((media.message_id, f"{type(e).__name__}: {e}"))
+            else:
+                context.completed.append(media.message_id)
+            finally:
+                context.media_queue.task_done()
+                if context.bar is not None:
+                    context.bar.update(1)
 
-            delay = max(MEDIA_DELAY - (time.time() - start), 0)
-            await asyncio.sleep(delay)
+    async def enqueue_media(
+        self,
+        context: DialogContext,
+        messages: List[types.Message],
+        records: List[Media],
+        defer: bool = True,
+    ) -> List[MediaJob]:
+        """
+        Enqueue the media the policy wants downloaded. Each message comes
+        along with its Media record. Waits for room in the queue when it is
+        full. Returns the jobs of the media enqueued.
+        """
 
-    def enqueue_media(self, messages: List[types.Message]) -> None:
-        for message in messages:
-            self._media_queue.put_nowait(message)
+        enqueued = []
+        for message, record in zip(messages, records):
+            decision, priority = self.policy.decide(record, defer=defer)
+            self.policy.count(decision, record)
+            if decision != MediaDecision.DOWNLOAD:
+                continue
 
-    async def start(self, dialog: types.Dialog) -> None:
+            if context.bar is not None:
+                context.bar.total += 1
+            await context.media_queue.put(
+                (
+                    priority,
+                    record.size or 0,
+                    next(context.sequence),
+                    MediaItem.from_message(message, context.dialog.id),
+                )
+            )
+            # The record was made from this message, for this dialog
+            enqueued.append(
+                MediaJob(
+                    context.dialog.id,
+                    message.id,
+                    media_id=record.media_id,
+                    size=record.size,
+                    priority=priority,
+                )
+            )
+
+        return enqueued
+
+    async def _complete_media_jobs(self, context: DialogContext) -> None:
         """
-        Starts the dump with the given dialog.
+        Delete the jobs of the media done so far, along with where it is
+        stored, and record the failures to retry later. Left to the caller to
+        commit.
         """
 
-        self._running = True
-        self._incomplete_download = None  # type: ignore
+        completed, context.completed = context.completed, []
+        await self.db.complete_media_jobs(context.dialog.id, completed)
+        await self.db.set_media_paths(
+            context.dialog.id,
+            {
+                message_id: media_path(context.dialog.id, message_id)
+                for message_id in completed
+            },
+        )
 
-        if self.with_media:
-            self._folderpath: str = self._create_download_folder(dialog)
-
-            # Create tqdm bars
-            med_bar = tqdm(
-                unit=" files",
-                desc="files",
-                total=0,
-                bar_format=BAR_FORMAT,
-                postfix={"chat": dialog.title},
-            )
+        failed, context.failed = context.failed, []
+        await self.db.fail_media_jobs(
+            context.dialog.id, failed, self.media_max_attempts, self.media_retry_delay
+        )
 
-            # Create asyncio Tasks
-            asyncio.ensure_future(self._media_consumer(self._media_queue, med_bar))
+    async def _resume_media_jobs(self, context: DialogContext) -> None:
+        """
+        Enqueue the media jobs left by previous runs (and the failed ones due
+        for another attempt), fetching their messages again by ID. They are
+        never deferred: the media checkpoint is already past their messages.
+        """
 
-            # Resume media download
-            resume_media = self.db.get_resume_media(channel_id=dialog.id)
+        dialog = context.dialog
+        resume_ids = await self.db.claim_media_jobs(channel_id=dialog.id)
+        resume_messages = []
+        if resume_ids:
             resume_messages = [
-                json.loads(message, object_hook=types.Message)
-                for message in resume_media
+                message
+                for message in await self.client.fetch_messages_by_ids(
+                    dialog=dialog, ids=resume_ids
+                )
+                if message is not None and self._check_media(message)
             ]
-            self.enqueue_media(resume_messages)
+        jobs = await self.enqueue_media(
+            context,
+            resume_messages,
+            [Media(message, channel_id=dialog.id) for message in resume_messages],
+            defer=False,
+        )
 
+        # Jobs of deleted messages, or that the policy now skips
+        dropped = set(resume_ids) - {job.message_id for job in jobs}
+        await self.db.complete_media_jobs(dialog.id, sorted(dropped))
+        await self.db.commit_changes()
+
+    async def _join_media_queue(self, context: DialogContext) -> None:
+        """
+        Wait for the media queue of a dialog to be done, deleting the jobs of
+        the media done every JOB_FLUSH_INTERVAL seconds.
+        """
+
+        join = asyncio.ensure_future(context.media_queue.join())
         try:
-            max_message_id = self.db.get_max_message_id(dialog.id)
+            while not join.done():
+                await asyncio.wait([join], timeout=JOB_FLUSH_INTERVAL)
+                await self._complete_media_jobs(context)
+                await self.db.commit_changes()
+        finally:
+            join.cancel()
 
-            count = 0
-            while self._running:
-                start = time.time()
+    def _pending_messages(
+        self,
+        dialog: types.Dialog,
+        max_message_id: int,
+        ranges: List[Tuple[int, int, int]],
+    ) -> int:
+        """
+        Estimate how many messages of the dialog are yet to be dumped, counting
+        the backfill ranges that aren't finished.
+        """
 
-                messages = await self.client.fetch_messages(
-                    dialog=dialog, limit=BATCH_SIZE, min_id=max_message_id
-                )
+        backfill = sum(end_id - checkpoint_id for _, checkpoint_id, end_id in ranges)
+        if dialog.message is None:
+            return backfill
 
-                # Stop if there are no new messages
-                count += len(messages)
-                if messages is None or len(messages) == 0:
-                    logger.info(
-                        f"Downloaded {count} new messages from dialog {dialog.name}"
-                    )
+        return max(dialog.message.id - max_message_id, 0) + backfill
+
+    async def _dialog_consumer(
+        self, dialogs: Dict[int, types.Dialog], job: Callable, since: datetime
+    ) -> None:
+        kind = job.__name__
+        keys = list(dialogs)
+        while True:
+            try:
+                key = await self.db.claim_lease(
+                    kind, keys, self.worker_id, since, self.lease_ttl
+                )
+                await self.db.commit_changes()
+                if key is None:
                     break
 
-                # Insert messages into the database
-                message_records = [
-                    Message(
-                        message=message,
-                        channel_id=dialog.id,
-                    )
-                    for message in messages
-                    if isinstance(message, types.Message)
+                await job(dialogs[key])
+
+                await self.db.finish_lease(kind, key, self.worker_id)
+                await self.db.commit_changes()
+            finally:
+                # Each dialog is run in this task, give back its connection
+                await self.db.release()
+
+    async def _heartbeat(self) -> None:
+        """
+        Keep the leases of this worker from expiring while it runs.
+        """
+
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                await self.db.renew_leases(self.worker_id, self.lease_ttl)
+                await self.db.commit_changes()
+            except Exception as e:
+                # Tried again on the next beat, before the leases expire
+                logger.warning(f"Could not renew the leases: {e}")
+            finally:
+                await self.db.release()
+
+    async def _claim_media_lease(self, dialog: types.Dialog) -> None:
+        """
+        Lease the media jobs of a dialog, waiting for the worker holding them
+        if any, so that start() and download_past_media() never download the
+        media of the same dialog at once.
+        """
+
+        await self.db.insert_leases(MEDIA_LEASE, [dialog.id])
+        while True:
+            since = await self.db.get_time()
+            key = await self.db.claim_lease(
+                MEDIA_LEASE, [dialog.id], self.worker_id, since, self.lease_ttl
+            )
+            await self.db.commit_changes()
+            if key is not None:
+                return
+
+            logger.info(f"Waiting for another worker on the media of {dialog.name}")
+            await asyncio.sleep(self.lease_ttl / 3)
+
+    async def _finish_media_lease(self, dialog: types.Dialog) -> None:
+        await self.db.finish_lease(MEDIA_LEASE, dialog.id, self.worker_id)
+        await self.db.commit_changes()
+
+    async def _run_dialogs(self, dialogs: List[types.Dialog], job: Callable) -> None:
+        """
+        Run a job over the dialogs, up to concurrency dialogs at a time, in
+        the given order. Each dialog is leased first, so that the workers
+        sharing the database split the dialogs between them, and a dialog
+        some worker finished during this run isn't run again.
+        """
+
+        if not dialogs:
+            return
+
+        kind = job.__name__
+        keys = [dialog.id for dialog in dialogs]
+        await self.db.insert_leases(kind, keys)
+        await self.db.free_leases(kind, self.worker_id)
+        await self.db.free_leases(MEDIA_LEASE, self.worker_id)
+        since = await self.db.get_time()
+        await self.db.commit_changes()
+
+        by_key = {dialog.id: dialog for dialog in dialogs}
+        consumers = [
+            asyncio.ensure_future(self._dialog_consumer(by_key, job, since))
+            for _ in range(min(self.concurrency, len(dialogs)))
+        ]
+        heartbeat = asyncio.ensure_future(self._heartbeat())
+
+        try:
+            await asyncio.gather(*consumers)
+        finally:
+            heartbeat.cancel()
+            for consumer in consumers:
+                consumer.cancel()
+
+    def _start_media_consumers(self, context: DialogContext) -> List[asyncio.Future]:
+        # Create tqdm bars
+        context.bar = tqdm(
+            unit=" files",
+            desc="files",
+            total=0,
+            bar_format=BAR_FORMAT,
+            postfix={"chat": context.dialog.title},
+        )
+
+        # Create asyncio Tasks
+        return [
+            asyncio.ensure_future(self._media_consumer(context))
+            for _ in range(self.media_workers)
+        ]
+
+    def _stop_media_consumers(
+        self, context: DialogContext, consumers: List[asyncio.Future]
+    ) -> None:
+        for consumer in consumers:
+            consumer.cancel()
+
+        if context.bar is not None:
+            context.bar.n = context.bar.total
+            context.bar.close()
+
+    async def _split_backfill(
+        self, dialog: types.Dialog, max_message_id: int
+    ) -> List[Tuple[int, int, int]]:
+        """
+        Split the message IDs of a dialog that are left to fetch into ranges,
+        stored so that an interrupted backfill resumes each range where it
+        stopped. Returns (start_id, checkpoint_id, end_id) of each range.
+        """
+
+        latest_id = dialog.message.id if dialog.message is not None else 0
+        count = min(
+            self.backfill_ranges, (latest_id - max_message_id) // MIN_RANGE_SIZE
+        )
+        if count < 2:
+            return []
+
+        bounds = [
+            max_message_id + (latest_id - max_message_id) * i // count
+            for i in range(count + 1)
+        ]
+        ranges = [(start, start, end) for start, end in zip(bounds, bounds[1:])]
+
+        await self.db.insert_backfill_ranges(
+            [BackfillRange(dialog.id, start, end) for start, _, end in ranges]
+        )
+
+        # Messages after the ranges are fetched as usual
+        await self.db.upsert_channel(
+            Channel(channel_id=dialog.id, name=dialog.name, max_message_id=latest_id)
+        )
+        await self.db.commit_changes()
+
+        logger.info(f"Backfilling dialog {dialog.title} in {count} ranges")
+
+        return ranges
+
+    async def _fetch_stage(
+        self,
+        context: DialogContext,
+        queue: asyncio.Queue,
+        counter: StageCounter,
+        min_id: int,
+        window: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        """
+        Fetch the messages after min_id, up to the end of the backfill range
+        (start_id, end_id] if a window is given.
+        """
+
+        max_id = window[1] + 1 if window is not None else None
+
+        while context.running:
+            counter.start()
+            messages = await self.client.fetch_messages(
+                dialog=context.dialog, limit=BATCH_SIZE, min_id=min_id, max_id=max_id
+            )
+
+            # Stop if there are no new messages
+            if messages is None or len(messages) == 0:
+                # An empty batch tells the range is complete
+                if window is not None:
+                    await queue.put((window, []))
+                break
+
+            counter.stop(len(messages))
+            await queue.put((window, messages))
+
+            # The next batch starts right after this one
+            min_id = max([message.id for message in messages])
+
+    async def _fetch_windows(
+        self,
+        context: DialogContext,
+        queue: asyncio.Queue,
+        counter: StageCounter,
+        max_message_id: int,
+        ranges: List[Tuple[int, int, int]],
+    ) -> None:
+        """
+        Fetch the backfill ranges and the messages after max_message_id at the
+        same time.
+        """
+
+        windows: List[Tuple[int, Optional[Tuple[int, int]]]] = [
+            (checkpoint_id, (start_id, end_id))
+            for start_id, checkpoint_id, end_id in ranges
+        ]
+        windows.append((max_message_id, None))
+
+        counters = [StageCounter(counter.name) for _ in windows]
+        try:
+            await asyncio.gather(
+                *[
+                    self._fetch_stage(context, queue, window_counter, min_id, window)
+                    for window_counter, (min_id, window) in zip(counters, windows)
                 ]
-                self.db.insert_messages(message_records)
-                self.db.flush_changes()
-
-                # Update max_message_id
-                max_id = max([message.id for message in messages])
-                if max_message_id is None or max_message_id < max_id:
-                    max_message_id = max_id
-
-                # Upsert dialog with updated max_message_id
-                self.db.upsert_channel(
-                    Channel(
-                        channel_id=dialog.id,
-                        name=dialog.name,
-                        max_message_id=max_message_id,  # type: ignore
-                    )
+            )
+        finally:
+            for window_counter in counters:
+                counter.merge(window_counter)
+
+        await queue.put(None)
+
+    async def _transform_stage(
+        self,
+        context: DialogContext,
+        in_queue: asyncio.Queue,
+        out_queue: asyncio.Queue,
+        counter: StageCounter,
+    ) -> None:
+        dialog = context.dialog
+
+        while (batch := await in_queue.get()) is not None:
+            counter.start()
+            window, messages = batch
+
+            message_records = [
+                Message(
+                    message=message,
+                    channel_id=dialog.id,
                 )
+                for message in messages
+                if isinstance(message, types.Message)
+            ]
+
+            messages_with_media = []
+            media_records = []
+            if self.with_media:
+                messages_with_media = [
+                    message for message in messages if self._check_media(message)
+                ]
+                media_records = [
+                    Media(message, channel_id=dialog.id)
+                    for message in messages_with_media
+                ]
+
+            max_id = max([message.id for message in messages], default=None)
+
+            counter.stop(len(messages))
+            await out_queue.put(
+                (window, message_records, messages_with_media, media_records, max_id)
+            )
+
+        await out_queue.put(None)
+
+    async def _write_stage(
+        self, context: DialogContext, queue: asyncio.Queue, counter: StageCounter
+    ) -> None:
+        dialog = context.dialog
+
+        try:
+            while (batch := await queue.get()) is not None:
+                counter.start()
+                (
+                    window,
+                    message_records,
+                    messages_with_media,
+                    media_records,
+                    max_id,
+                ) = batch
+
+                # Insert messages into the database
+                await self.db.insert_messages(message_records)
+                await self.db.flush_changes()
+
+                if window is None:
+                    # Upsert dialog with updated max_message_id
+                    await self.db.upsert_channel(
+                        Channel(
+                            channel_id=dialog.id,
+                            name=dialog.name,
+                            max_message_id=max_id,
+                        )
+                    )
+                elif max_id is None:
+                    # The backfill range has been fetched completely
+                    await self.db.delete_backfill_range(dialog.id, window[0])
+                else:
+                    await self.db.update_backfill_range(dialog.id, window[0], max_id)
 
                 if self.with_media:
                     # Insert media metadata into the database
-                    media_records = [
-                        Media(message, channel_id=dialog.id)
-                        for message in messages
-                        if self._check_media(message)
-                    ]
-                    self.db.insert_media(media_records)
+                    await self.db.insert_media(media_records)
 
-                    # Enqueue messages with media to be downloaded
-                    messages_with_media = [
-                        message for message in messages if self._check_media(message)
-                    ]
-                    med_bar.total += len(messages_with_media)
-                    self.enqueue_media(messages_with_media)
+                    # Enqueue messages with media to be downloaded, writing
+                    # their jobs along with the messages
+                    jobs = await self.enqueue_media(
+                        context, messages_with_media, media_records
+                    )
+                    await self.db.insert_media_jobs(jobs)
+                    await self._complete_media_jobs(context)
 
                 # Commit transaction
-                self.db.commit_changes()
+                await self.db.commit_changes()
+                counter.stop(len(message_records))
+        finally:
+            await self.db.release()
+
+    async def start(self, dialog: types.Dialog) -> None:
+        """
+        Starts the dump with the given dialog.
+        """
+
+        logger.info(f"Getting messages from dialog {dialog.title}")
+
+        context = DialogContext(dialog)
+        context.running = True
+
+        if self.with_media:
+            await self._claim_media_lease(dialog)
+            consumers = self._start_media_consumers(context)
+            await self._resume_media_jobs(context)
 
-                delay = max(HISTORY_DELAY - (time.time() - start), 0)
-                await asyncio.sleep(delay)
+        max_message_id = await self.db.get_max_message_id(dialog.id) or 0
+
+        # Resume the backfill ranges of a previous run, or split a large
+        # backlog of messages into ranges fetched at the same time
+        ranges = await self.db.get_backfill_ranges(dialog.id)
+        if not ranges:
+            ranges = await self._split_backfill(dialog, max_message_id)
+            if ranges:
+                max_message_id = ranges[-1][2]
+
+        # Fetching, transforming and writing happen at the same time, each
+        # stage waiting on the previous one when it runs out of work
+        fetched: asyncio.Queue[Any] = asyncio.Queue(
+            maxsize=PIPELINE_DEPTH * (len(ranges) + 1)
+        )
+        transformed: asyncio.Queue[Any] = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+        counters = [StageCounter(name) for name in self.counters]
+        stages = [
+            asyncio.ensure_future(
+                self._fetch_windows(
+                    context, fetched, counters[0], max_message_id, ranges
+                )
+            ),
+            asyncio.ensure_future(
+                self._transform_stage(context, fetched, transformed, counters[1])
+            ),
+            asyncio.ensure_future(self._write_stage(context, transformed, counters[2])),
+        ]
+
+        try:
+            await asyncio.gather(*stages)
+            logger.info(
+                f"Downloaded {counters[0].items} new messages from dialog {dialog.name}"
+            )
+            for counter in counters:
+                self.counters[counter.name].merge(counter)
+
+            await self._reschedule(dialog)
 
             if self.with_media:
-                await self._media_queue.join()
+                await self._join_media_queue(context)
 
         finally:
-            self._running = False
+            context.running = False
+
+            for stage in stages:
+                stage.cancel()
 
             if self.with_media:
-                med_bar.n = med_bar.total
-                med_bar.close()
+                # Media left in the queue keeps its job for the next run
+                self._stop_media_consumers(context, consumers)
+                await self._complete_media_jobs(context)
+                await self.db.commit_changes()
+                await self._finish_media_lease(dialog)
 
-                # If the download was interrupted and there is media left in the
-                # queue we want to save them into the database for the next run.
-                media = []
-                while not self._media_queue.empty():
-                    message = self._media_queue.get_nowait()
-                    media.append(ResumeMedia(message, channel_id=dialog.id))
+    async def update_channel_info(self, dialog: types.Dialog) -> None:
+        """
+        Fetch the full info of an active channel if the latest one is older
+        than channel_info_interval, and store it if it changed.
+        """
+
+        if not dialog.is_channel:
+            return
+
+        channel = await self.db.get_channel_by_id(dialog.id)
+        if channel is None or not channel.is_active:
+            return
+
+        age = await self.db.get_channel_data_age(dialog.id)
+        if age is not None and age < self.channel_info_interval:
+            return
+
+        try:
+            data = await self.client.get_dialog_info(dialog)
+        except (ValueError, errors.RPCError) as e:
+            logger.warning(f"Could not get info of dialog {dialog.name}: {e}")
+            return
+
+        changed = await self.db.upsert_channel_data(dialog.id, data)
+        await self.db.commit_changes()
 
-                self.db.insert_resume_media(resume_media=media)
+        if changed:
+            logger.info(f"Stored new info of dialog {dialog.name}")
 
-                if media:
-                    self.db.commit_changes()
+    async def _reschedule(self, dialog: types.Dialog) -> None:
+        """
+        Schedule the next poll of a dialog whose history is now complete,
+        from its recent messages.
+        """
 
-                # Delete partially-downloaded files
-                if self._incomplete_download is not None and os.path.isfile(
-                    self._incomplete_download
-                ):
-                    os.remove(self._incomplete_download)
+        recent, idle, age = await self.db.get_channel_activity(
+            dialog.id, self.schedule.window
+        )
+        rate, interval, active = self.schedule.plan(recent, idle, age)
+        await self.db.schedule_channel(dialog.id, rate, interval, active, True)
+        await self.db.commit_changes()
+
+        if not active:
+            logger.info(f"Dialog {dialog.name} is inactive")
 
     async def download_past_media(self, dialog: types.Dialog) -> None:
         """
         Downloads the past media that has already been dumped into the
         database but has not been downloaded for the given dialog yet.
 
-        Media with formatted filename results in an already-existing file
-        will be *ignored* and not re-downloaded again.
+        Media that is already in the store will *not* be re-downloaded, only
+        linked into the dialog's folder. Progress is saved after each batch,
+        so an interrupted run resumes where it stopped, and media that failed
+        keeps a job that is tried again by later runs.
         """
 
-        print("Not implemented!")
-        pass
+        logger.info(f"Getting past media from dialog {dialog.title}")
+
+        await self._claim_media_lease(dialog)
+        context = DialogContext(dialog)
+        context.running = True
+        consumers = self._start_media_consumers(context)
+
+        if self._stored_media is None:
+            self._stored_media = self.store.index()
+
+        try:
+            # Failed media due for another attempt goes first
+            await self._resume_media_jobs(context)
+            await self._join_media_queue(context)
+
+            channel = await self.db.get_channel_by_id(dialog.id)
+            # A channel that was just added has no checkpoint yet
+            checkpoint = (channel.media_checkpoint_id or 0) if channel else 0
+
+            count = 0
+            while True:
+                media = await self.db.get_media_after(
+                    channel_id=dialog.id, message_id=checkpoint, limit=BATCH_SIZE
+                )
+                if len(media) == 0:
+                    break
+
+                # Only ask Telegram for media that was never downloaded, and
+                # that the policy doesn't skip
+                missing = {}
+                linked = {}
+                for record in media:
+                    key = media_key(record.media_id, record.is_document)
+                    if record.local_path is not None:
+                        continue
+                    elif key in self._stored_media:
+                        local_path = media_path(dialog.id, record.message_id)
+                        self.store.link(key, os.path.join(DOWNLOAD_FOLDER, local_path))
+                        linked[record.message_id] = local_path
+                    elif self.policy.decide(record)[0] != MediaDecision.SKIP:
+                        missing[record.message_id] = record
+
+                if missing:
+                    messages = [
+                        message
+                        for message in await self.client.fetch_messages_by_ids(
+                            dialog=dialog, ids=list(missing)
+                        )
+                        if message is not None and self._check_media(message)
+                    ]
+                    jobs = await self.enqueue_media(
+                        context,
+                        messages,
+                        [missing[message.id] for message in messages],
+                        defer=False,
+                    )
+                    await self.db.insert_media_jobs(jobs)
+                    await context.media_queue.join()
+                    count += len(messages)
+
+                await self.db.set_media_paths(dialog.id, linked)
+                await self._complete_media_jobs(context)
+
+                checkpoint = media[-1].message_id
+                await self.db.update_media_checkpoint(
+                    channel_id=dialog.id, message_id=checkpoint
+                )
+                await self.db.commit_changes()
+
+            logger.info(f"Downloaded {count} past media from dialog {dialog.name}")
+
+        finally:
+            context.running = False
+            self._stop_media_consumers(context, consumers)
+            await self._finish_media_lease(dialog)
 
     async def download_participants(self, dialog: types.Dialog) -> None:
-        users = await self.client.get_dialog_users(dialog=dialog)
-        logger.info(f"Downloaded {len(users)} users from dialog {dialog.name}")
+        """
+        Sync the participants of a dialog with the ones stored, page by page.
+        Only new and changed users are written, and users no longer listed
+        are marked as having left.
+        """
 
-        # Insert users into the database
-        user_records = [User(user) for user in users]
-        self.db.insert_users(user_records)
-        self.db.flush_changes()
+        logger.info(f"Getting participants from dialog {dialog.title}")
 
-        # Insert user and channels relationship into the database
-        user_channel_records = [
-            UserChannel(channel_id=dialog.id, user_id=user.id) for user in users
-        ]
-        self.db.insert_users_channels(user_channel_records)
+        stored = await self.db.get_channel_users(dialog.id)
+        seen: Set[int] = set()
+        total = joined = changed = 0
 
-        # Commit transaction
-        self.db.commit_changes()
+        async for users, total in self.client.iter_dialog_users(dialog):
+            # Records by the IDs of their users, which are never missing
+            records = {user.id: User(user) for user in users if user.id not in seen}
+            seen.update(records)
 
-    async def download_dialogs(self) -> None:
+            new_ids = [user_id for user_id in records if user_id not in stored]
+            changed_ids = [
+                user_id
+                for user_id, record in records.items()
+                if user_id in stored and stored[user_id] != _user_values(record)
+            ]
+            joined += len(new_ids)
+            changed += len(changed_ids)
+
+            # Users new to the dialog may already be known from others
+            await self.db.insert_users([records[id] for id in new_ids + changed_ids])
+            await self.db.flush_changes()
+
+            await self.db.insert_users_channels(
+                [UserChannel(channel_id=dialog.id, user_id=id) for id in new_ids]
+            )
+            await self.db.set_users_left(dialog.id, new_ids, left=False)
+            await self.db.commit_changes()
+
+        # Users may only be told gone if every participant was listed
+        left = [user_id for user_id in stored if user_id not in seen]
+        if len(seen) >= total:
+            await self.db.set_users_left(dialog.id, left, left=True)
+            await self.db.commit_changes()
+        else:
+            logger.info(f"Listed {len(seen)} of {total} users, not checking for left")
+            left = []
+
+        logger.info(
+            f"Synced {len(seen)} users from dialog {dialog.name}: {joined} joined, "
+            f"{changed} changed, {len(left)} left"
+        )
+
+    async def _get_dialogs(self) -> List[types.Dialog]:
         """
-        Perform a dump of the dialogs we've been told to act on.
+        Get the dialogs we've been told to act on.
         """
 
         dialogs = await self.client.get_dialogs()
@@ -252,21 +960,218 @@ class Downloader:
         elif self.blacklist:
             dialogs = [dialog for dialog in dialogs if dialog.id not in self.blacklist]
 
-        for dialog in dialogs:
-            logger.info(f"Getting messages from dialog {dialog.title}")
+        return dialogs
 
+    async def _init_channels(self, dialogs: List[types.Dialog]) -> Dict[int, int]:
+        """
+        Initialize the dialogs missing from the database, and return the number
+        of messages pending for each dialog.
+        """
+
+        pending = {}
+        for dialog in dialogs:
             # If the dialog is not in the database, initialize it
-            if self.db.get_channel_by_id(dialog.id) is None:
-                self.db.upsert_channel(
-                    channel=Channel(
-                        channel_id=dialog.id,
-                        name=dialog.name,
-                    )
+            channel = await self.db.get_channel_by_id(dialog.id)
+            if channel is None:
+                channel = Channel(channel_id=dialog.id, name=dialog.name)
+                await self.db.upsert_channel(channel=channel)
+                await self.db.commit_changes()
+
+            max_message_id = channel.max_message_id or 0
+            ranges = await self.db.get_backfill_ranges(dialog.id)
+            pending[dialog.id] = self._pending_messages(dialog, max_message_id, ranges)
+
+        return pending
+
+    async def _report_media_jobs(self) -> None:
+        stats = await self.db.get_media_job_stats()
+        for state in ["pending", "failed", "dead"]:
+            count, size = stats.get(state, (0, 0))
+            logger.info(f"Media jobs {state}: {count} ({size / 2**30:.2f}GB)")
+
+    async def download_dialogs(self) -> None:
+        """
+        Perform a dump of the dialogs we've been told to act on.
+        """
+
+        dialogs = await self._get_dialogs()
+        pending = await self._init_channels(dialogs)
+        await self._run_dialogs(dialogs, self.update_channel_info)
+
+        # Only poll the dialogs due, according to how busy they are
+        if not self.ignore_schedule:
+            due = set(await self.db.get_due_channels(list(pending)))
+            logger.info(f"Polling {len(due)} of {len(dialogs)} dialogs due")
+            dialogs = [dialog for dialog in dialogs if dialog.id in due]
+
+        # Dialogs with fewer new messages go first, so that a few huge dialogs
+        # do not hold up all the small ones
+        await self._run_dialogs(
+            sorted(dialogs, key=lambda dialog: pending[dialog.id]), self.start
+        )
+
+        for counter in self.counters.values():
+            logger.info(f"Stage {counter}")
+
+        if self.with_media:
+            self.policy.report()
+            await self._report_media_jobs()
+
+    def _live_context(self, dialog: types.Dialog) -> DialogContext:
+        if dialog.id not in self._live_contexts:
+            context = DialogContext(dialog)
+            context.running = True
+            consumers = self._start_media_consumers(context)
+            self._live_contexts[dialog.id] = (context, consumers)
+
+        return self._live_contexts[dialog.id][0]
+
+    async def _write_live(self, dialog: types.Dialog, batch: List[Tuple]) -> None:
+        """
+        Write the messages pushed for a dialog. The dialog's max_message_id
+        only moves over new messages that directly follow it, so that any
+        message the updates missed is left for the gap check.
+        """
+
+        messages = [
+            message for message, _ in batch if isinstance(message, types.Message)
+        ]
+        await self.db.insert_messages(
+            [Message(message=message, channel_id=dialog.id) for message in messages]
+        )
+        await self.db.flush_changes()
+
+        max_message_id = await self.db.get_max_message_id(dialog.id) or 0
+        watermark = max_message_id
+        new_ids = {message.id for message, edited in batch if not edited}
+        for message_id in sorted(new_ids):
+            if message_id == watermark + 1:
+                watermark = message_id
+            elif message_id > watermark:
+                break
+
+        if watermark > max_message_id:
+            await self.db.upsert_channel(
+                Channel(
+                    channel_id=dialog.id, name=dialog.name, max_message_id=watermark
                 )
-                self.db.commit_changes()
+            )
+
+        if self.with_media:
+            messages_with_media = [
+                message for message in messages if self._check_media(message)
+            ]
+            media_records = [
+                Media(message, channel_id=dialog.id) for message in messages_with_media
+            ]
+            await self.db.insert_media(media_records)
+
+            context = self._live_context(dialog)
+            jobs = await self.enqueue_media(context, messages_with_media, media_records)
+            await self.db.insert_media_jobs(jobs)
+            await self._complete_media_jobs(context)
+
+        await self.db.commit_changes()
+
+    async def _write_live_batch(self, batch: List[Tuple[types.Message, bool]]) -> None:
+        """
+        Write a batch of pushed messages, one transaction for each dialog, so
+        that a dialog failing to be written doesn't hold up the others.
+        """
+
+        batches: DefaultDict[int, List[Tuple]] = defaultdict(list)
+        for message, edited in batch:
+            # Dialogs joined since the last gap check are left to it
+            if message.chat_id in self._followed:
+                batches[message.chat_id].append((message, edited))
+
+        for dialog_id, dialog_batch in batches.items():
+            try:
+                await self._write_live(self._followed[dialog_id], dialog_batch)
+            except Exception as e:
+                logger.warning(f"Failed to write live messages: {e}")
+
+                # The failure aborted the transaction, the next dialog gets a
+                # new one
+                await self.db.release()
+
+    async def _live_writer(self, queue: asyncio.Queue) -> None:
+        """
+        Write pushed messages in batches, gathering messages for at most
+        follow_latency seconds after the first one arrives.
+        """
+
+        loop = asyncio.get_running_loop()
+        counter = self.live_counter
 
-            # Ingest new messages
-            await self.start(dialog)
+        try:
+            while True:
+                batch = [await queue.get()]
+                deadline = loop.time() + self.follow_latency
+                while len(batch) < BATCH_SIZE:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                counter.start()
+                await self._write_live_batch(batch)
+                counter.stop(len(batch))
+        finally:
+            await self.db.release()
+
+    async def _check_gaps(self) -> None:
+        """
+        Fetch the history of the dialogs whose latest message is past their
+        max_message_id, which is where the updates may have missed messages.
+        """
+
+        dialogs = await self._get_dialogs()
+        pending = await self._init_channels(dialogs)
+        self._followed = {dialog.id: dialog for dialog in dialogs}
+        await self._run_dialogs(dialogs, self.update_channel_info)
+
+        behind = [dialog for dialog in dialogs if pending[dialog.id] > 0]
+        logger.info(f"Gap check: {len(behind)} of {len(dialogs)} dialogs behind")
+
+        await self._run_dialogs(
+            sorted(behind, key=lambda dialog: pending[dialog.id]), self.start
+        )
+
+    async def follow(self) -> None:
+        """
+        Keep the dialogs we've been told to act on up to date, writing the
+        messages Telegram pushes as they come, and checking for missed
+        messages every gap_check_interval seconds.
+        """
+
+        queue: asyncio.Queue[Tuple[types.Message, bool]] = asyncio.Queue()
+
+        async def on_message(message: types.Message, edited: bool) -> None:
+            await queue.put((message, edited))
+
+        # Handlers come first, so that nothing is missed during the first check
+        self.client.add_message_handler(on_message)
+        writer = asyncio.ensure_future(self._live_writer(queue))
+
+        try:
+            while True:
+                await self._check_gaps()
+                logger.info(f"Stage {self.live_counter}")
+                await asyncio.sleep(self.gap_check_interval)
+        finally:
+            writer.cancel()
+            with suppress(asyncio.CancelledError):
+                await writer
+
+            for context, consumers in self._live_contexts.values():
+                context.running = False
+                self._stop_media_consumers(context, consumers)
+                await self._complete_media_jobs(context)
+                await self.db.commit_changes()
 
     async def download_past_media_from_dialogs(self) -> None:
         """
@@ -274,34 +1179,15 @@ class Downloader:
         dialogs we've been told to act on
         """
 
-        dialogs = await self.client.get_dialogs()
-        if self.whitelist:
-            dialogs = [dialog for dialog in dialogs if dialog.id in self.whitelist]
-        elif self.blacklist:
-            dialogs = [dialog for dialog in dialogs if dialog.id not in self.blacklist]
+        dialogs = await self._get_dialogs()
 
-        for dialog in dialogs:
-            logger.info(f"Getting past media from dialog {dialog.title}")
-            await self.download_past_media(dialog=dialog)
-
-    async def download_participants_from_dialogs(self) -> None:
-        dialogs = await self.client.get_dialogs()
-        if self.whitelist:
-            dialogs = [dialog for dialog in dialogs if dialog.id in self.whitelist]
-        elif self.blacklist:
-            dialogs = [dialog for dialog in dialogs if dialog.id not in self.blacklist]
+        await self._run_dialogs(dialogs, self.download_past_media)
 
-        for dialog in dialogs:
-            logger.info(f"Getting participants from dialog {dialog.title}")
+        self.policy.report()
+        await self._report_media_jobs()
 
-            # If the dialog is not in the database, initialize it
-            if self.db.get_channel_by_id(dialog.id) is None:
-                self.db.upsert_channel(
-                    channel=Channel(
-                        channel_id=dialog.id,
-                        name=dialog.name,
-                    )
-                )
-                self.db.commit_changes()
+    async def download_participants_from_dialogs(self) -> None:
+        dialogs = await self._get_dialogs()
+        await self._init_channels(dialogs)
 
-            await self.download_participants(dialog=dialog)
+        await self._run_dialogs(dialogs, self.download_participants)
@@ -0,0 +1,98 @@
+from typing import Any, Optional, Union
+
+from telethon.tl import types
+
+InputLocation = Union[types.InputDocumentFileLocation, types.InputPhotoFileLocation]
+
+
+class MediaItem:
+    """
+    What it takes to download the media of a message, without holding on to
+    the message itself. Queued media is kept as these, so that its memory
+    doesn't grow with the text, entities and thumbnails of the messages.
+    """
+
+    __slots__ = (
+        "channel_id",
+        "message_id",
+        "media_id",
+        "dc_id",
+        "size",
+        "location",
+        "is_document",
+        "source",
+    )
+
+    def __init__(
+        self,
+        channel_id: int,
+        message_id: int,
+        media_id: int,
+        dc_id: int,
+        size: int,
+        location: InputLocation,
+        is_document: bool,
+        source: Optional[Any] = None,
+    ) -> None:
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.media_id = media_id
+        self.dc_id = dc_id
+        self.size = size
+        self.location = location
+        self.is_document = is_document
+
+        # The Telethon client that fetched the message, which is the one its
+        # file reference is valid for
+        self.source = source
+
+    @classmethod
+    def from_message(cls, message: types.Message, channel_id: int) -> "MediaItem":
+        """
+        Get the media of a message with a document or a photo.
+        """
+
+        source = getattr(message, "_client", None)
+
+        if isinstance(message.media, types.MessageMediaDocument):
+            document = message.media.document
+            location = types.InputDocumentFileLocation(
+                id=document.id,
+                access_hash=document.access_hash,
+                file_reference=document.file_reference,
+                thumb_size="",
+            )
+            return cls(
+                channel_id,
+                message.id,
+                document.id,
+                document.dc_id,
+                document.size,
+                location,
+                True,
+                source,
+            )
+
+        # Photos are downloaded in their largest size
+        photo = message.media.photo
+        size, thumb_size = 0, ""
+        for photo_size in photo.sizes:
+            if isinstance(photo_size, types.PhotoSize):
+                largest = photo_size.size
+            elif isinstance(photo_size, types.PhotoSizeProgressive):
+                largest = max(photo_size.sizes)
+            else:
+                continue
+
+            if largest >= size:
+                size, thumb_size = largest, photo_size.type
+
+        location = types.InputPhotoFileLocation(
+            id=photo.id,
+            access_hash=photo.access_hash,
+            file_reference=photo.file_reference,
+            thumb_size=thumb_size,
+        )
+        return cls(
+            channel_id, message.id, photo.id, photo.dc_id, size, location, False, source
+        )
@@ -5,8 +5,10 @@ from sqlalchemy import (
     BigInteger,
     Boolean,
     Column,
+    Float,
     ForeignKey,
     ForeignKeyConstraint,
+    Index,
     Integer,
     Text,
     UniqueConstraint,
@@ -16,6 +18,8 @@ from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from telethon import types
 
+from .serialize import MESSAGE_FIELDS, content_hash, to_native
+
 Base = declarative_base()
 
 
@@ -26,10 +30,17 @@ class Channel(Base):
     channel_id = Column(BigInteger, nullable=False, unique=True)
     name = Column(Text, nullable=False)
     max_message_id = Column(Integer, nullable=False)
+    media_checkpoint_id = Column(BigInteger, nullable=False, server_default="0")
 
+    # Inactive channels got no messages for a long time, and complete ones
+    # have had their whole history downloaded
     is_active = Column(Boolean, nullable=False, server_default="TRUE")
     is_complete = Column(Boolean, nullable=False, server_default="FALSE")
 
+    # Recent messages per day, and when to poll for new messages again
+    message_rate = Column(Float, nullable=True)
+    next_poll_utc = Column(TIMESTAMP, nullable=True)
+
     retrieved_utc = Column(TIMESTAMP, nullable=False, server_default=func.now())
     updated_utc = Column(
         TIMESTAMP, nullable=False, server_default=func.now(), onupdate=func.now()
@@ -79,6 +90,7 @@ class Message(Base):
         UniqueConstraint(
             "message_id", "channel_id", name="uq_messages_message_id_channel_id"
         ),
+        Index("ix_messages_channel_id_message_id", "channel_id", "message_id"),
     )
 
     def __init__(
@@ -88,7 +100,7 @@ class Message(Base):
     ):
         self.message_id = message.id
         self.channel_id = int(channel_id)
-        self.data = message.to_json()
+        self.data = to_native(message, fields=MESSAGE_FIELDS)
         self.message = message.message
         self.views = message.views
         self.forwards = message.forwards
@@ -167,6 +179,9 @@ class UserChannel(Base):
     channel_id = Column(BigInteger, ForeignKey(Channel.channel_id), nullable=False)
     user_id = Column(BigInteger, ForeignKey(User.user_id), nullable=False)
 
+    # When the user was found to have left the channel, if they did
+    left_utc = Column(TIMESTAMP, nullable=True)
+
     __table_args__ = (
         UniqueConstraint(
             "user_id", "channel_id", name="uq_users_channels_user_id_channel_id"
@@ -192,6 +207,9 @@ class Media(Base):
     type = Column(Text, nullable=True)
     size = Column(Integer, nullable=True)
 
+    # Where the media was downloaded to, relative to the downloads folder
+    local_path = Column(Text, nullable=True)
+
     message_utc = Column(TIMESTAMP, nullable=False)
     retrieved_utc = Column(TIMESTAMP, nullable=False, server_default=func.now())
     updated_utc = Column(
@@ -202,6 +220,9 @@ class Media(Base):
         ForeignKeyConstraint(
             [channel_id, message_id], [Message.channel_id, Message.message_id]
         ),
+        UniqueConstraint(
+            "channel_id", "message_id", name="uq_media_channel_id_message_id"
+        ),
     )
 
     def __init__(
@@ -240,6 +261,11 @@ class Media(Base):
 
             self.message_utc = photo.date
 
+    @property
+    def is_document(self) -> bool:
+        # Photos don't have a type of their own
+        return self.type is not None
+
     def _match_doc_type(self, attribute) -> Optional[str]:
         match attribute:
             case types.DocumentAttributeImageSize():
@@ -256,25 +282,156 @@ class Media(Base):
                 return None
 
 
-class ResumeMedia(Base):
-    __tablename__ = "resume_media"
+class MediaJob(Base):
+    """
+    Media waiting to be downloaded. Jobs are written along with their messages
+    and deleted once done, so that the download queue outlives the process.
+    A job that fails is "failed" until next_attempt_utc, and "dead" once it
+    failed too many times.
+    """
+
+    __tablename__ = "media_jobs"
 
     id = Column(Integer, primary_key=True)
     channel_id = Column(BigInteger, nullable=False)
     message_id = Column(BigInteger, nullable=False)
-    data = Column(JSONB, nullable=False)
+    media_id = Column(BigInteger, nullable=True)
+    size = Column(BigInteger, nullable=True)
+    priority = Column(Integer, nullable=False, server_default="0")
+
+    state = Column(Text, nullable=False, server_default="pending")
+    attempts = Column(Integer, nullable=False, server_default="0")
+    last_error = Column(Text, nullable=True)
+    next_attempt_utc = Column(TIMESTAMP, nullable=True)
+
+    created_utc = Column(TIMESTAMP, nullable=False, server_default=func.now())
+    updated_utc = Column(
+        TIMESTAMP, nullable=False, server_default=func.now(), onupdate=func.now()
+    )
 
     __table_args__ = (
         ForeignKeyConstraint(
             [channel_id, message_id], [Message.channel_id, Message.message_id]
         ),
+        UniqueConstraint(
+            "channel_id", "message_id", name="uq_media_jobs_channel_id_message_id"
+        ),
+        Index("ix_media_jobs_channel_id_state", "channel_id", "state"),
     )
 
     def __init__(
         self,
-        message: types.Message,
         channel_id: int,
-    ):
+        message_id: int,
+        media_id: Optional[int] = None,
+        size: Optional[int] = None,
+        priority: int = 0,
+    ) -> None:
         self.channel_id = channel_id
-        self.message_id = message.id
-        self.data = message.to_json()
+        self.message_id = message_id
+        self.media_id = media_id
+        self.size = size
+        self.priority = priority
+
+
+class BackfillRange(Base):
+    """
+    A window of message IDs (start_id, end_id] of a channel being backfilled.
+    checkpoint_id is the last message ID written for the range.
+    """
+
+    __tablename__ = "backfill_ranges"
+
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(BigInteger, ForeignKey(Channel.channel_id), nullable=False)
+    start_id = Column(BigInteger, nullable=False)
+    end_id = Column(BigInteger, nullable=False)
+    checkpoint_id = Column(BigInteger, nullable=False)
+
+    retrieved_utc = Column(TIMESTAMP, nullable=False, server_default=func.now())
+    updated_utc = Column(
+        TIMESTAMP, nullable=False, server_default=func.now(), onupdate=func.now()
+    )
+
+    __table_args__ = (
+        UniqueConstraint(
+            "channel_id", "start_id", name="uq_backfill_ranges_channel_id_start_id"
+        ),
+    )
+
+    def __init__(self, channel_id: int, start_id: int, end_id: int) -> None:
+        self.channel_id = channel_id
+        self.start_id = start_id
+        self.end_id = end_id
+        self.checkpoint_id = start_id
+
+
+class ChannelSnapshot(Base):
+    """
+    A version of the full info of a channel. A new snapshot is only stored
+    when the info changes, checked_utc being when it was last seen unchanged.
+    """
+
+    __tablename__ = "channel_snapshots"
+
+    # Fields of the full info that change without the channel changing
+    VOLATILE_FIELDS = {
+        "online_count",
+        "read_inbox_max_id",
+        "read_outbox_max_id",
+        "unread_count",
+        "available_min_id",
+        "pts",
+        "notify_settings",
+        "file_reference",
+        "requests_pending",
+        "recent_requesters",
+    }
+
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(
+        BigInteger, ForeignKey(Channel.channel_id), nullable=False, index=True
+    )
+    participants_count = Column(Integer, nullable=True)
+    about = Column(Text, nullable=True)
+    data = Column(JSONB, nullable=False)
+    content_hash = Column(Text, nullable=False)
+
+    retrieved_utc = Column(TIMESTAMP, nullable=False, server_default=func.now())
+    checked_utc = Column(TIMESTAMP, nullable=False, server_default=func.now())
+
+    def __init__(self, channel_id: int, data: dict) -> None:
+        self.channel_id = channel_id
+
+        full_chat = data.get("full_chat", {})
+        self.participants_count = full_chat.get("participants_count")
+        self.about = full_chat.get("about")
+
+        self.data = data
+        self.content_hash = content_hash(data, ignore=self.VOLATILE_FIELDS)
+
+
+class Lease(Base):
+    """
+    A claim of a worker over a unit of work, such as downloading a dialog, so
+    that several workers sharing the database split the work between them.
+    A lease is held until expires_utc, which its owner keeps pushing back,
+    and is taken over by other workers once it expires.
+    """
+
+    __tablename__ = "leases"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(Text, nullable=False)
+    key = Column(BigInteger, nullable=False)
+
+    owner = Column(Text, nullable=True)
+    acquired_utc = Column(TIMESTAMP, nullable=True)
+    expires_utc = Column(TIMESTAMP, nullable=True)
+    finished_utc = Column(TIMESTAMP, nullable=True)
+
+    __table_args__ = (UniqueConstraint("kind", "key", name="uq_leases_kind_key"),)
+
+    def __init__(self, kind: str, key: int) -> None:
+        self.kind = kind
+        self.key = key
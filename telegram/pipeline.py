@@ -0,0 +1,35 @@
+import time
+
+
+class StageCounter:
+    """
+    Throughput counters of one stage of an ingestion pipeline.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self.busy = 0.0
+
+        self._started = 0.0
+
+    def start(self) -> None:
+        self._started = time.monotonic()
+
+    def stop(self, items: int) -> None:
+        self.busy += time.monotonic() - self._started
+        self.batches += 1
+        self.items += items
+
+    def merge(self, other: "StageCounter") -> None:
+        self.batches += other.batches
+        self.items += other.items
+        self.busy += other.busy
+
+    def __str__(self) -> str:
+        rate = self.items / self.busy if self.busy else 0
+        return (
+            f"{self.name}: {self.items} items in {self.batches} batches, "
+            f"{self.busy:.1f}s busy, {rate:.0f} items/s"
+        )
@@ -0,0 +1,96 @@
+from collections import defaultdict
+from enum import Enum
+from typing import DefaultDict, Dict, List, Optional, Tuple
+
+from .common import logger
+from .models import Media
+
+# Priority of each kind of media, lower values are downloaded first
+DEFAULT_PRIORITIES = {
+    "photo": 0,
+    "image": 1,
+    "gif": 2,
+    "audio": 3,
+    "document": 4,
+    "video": 5,
+}
+
+# Kinds of media from the most specific to the least. A document of several
+# kinds (a video with a file name is "video,document") is the most specific.
+SPECIFICITY = ["gif", "image", "audio", "video", "photo", "document"]
+
+
+class MediaDecision(Enum):
+    DOWNLOAD = 1
+    DEFER = 2
+    SKIP = 3
+
+
+class MediaPolicy:
+    """
+    Decide which media should be downloaded, and in which order, from the
+    metadata stored in Media records. Deferred media is left for a later
+    --download-past-media run, skipped media is never downloaded.
+    """
+
+    def __init__(self, options: Optional[dict] = None) -> None:
+        options = options or {}
+
+        self.max_size: Optional[int] = options.get("max_size")
+        self.defer_size: Optional[int] = options.get("defer_size")
+        self.mime_types: Optional[List[str]] = options.get("mime_types")
+
+        # The priorities given override the default ones, and a kind given no
+        # priority is never downloaded
+        self.priorities: Dict[str, Optional[int]] = {
+            **DEFAULT_PRIORITIES,
+            **(options.get("priorities") or {}),
+        }
+
+        # Bytes of media per decision and kind of media
+        self.bytes: DefaultDict[Tuple[MediaDecision, str], int] = defaultdict(int)
+
+    def _kind(self, media: Media) -> str:
+        # Photos don't have a type of their own
+        if media.type is None:
+            return "photo"
+
+        kinds = [kind for kind in media.type.split(",") if kind in SPECIFICITY]
+
+        return min(kinds, key=SPECIFICITY.index, default="document")
+
+    def decide(self, media: Media, defer: bool = True) -> Tuple[MediaDecision, int]:
+        """
+        Decide what to do with a media, along with its download priority.
+        """
+
+        size = media.size or 0
+
+        priority = self.priorities.get(self._kind(media))
+
+        if priority is None:
+            decision = MediaDecision.SKIP
+        elif self.mime_types is not None and (
+            media.mime_type is not None and media.mime_type not in self.mime_types
+        ):
+            decision = MediaDecision.SKIP
+        elif self.max_size is not None and size > self.max_size:
+            decision = MediaDecision.SKIP
+        elif defer and self.defer_size is not None and size > self.defer_size:
+            decision = MediaDecision.DEFER
+        else:
+            decision = MediaDecision.DOWNLOAD
+
+        return decision, priority or 0
+
+    def count(self, decision: MediaDecision, media: Media) -> None:
+        self.bytes[(decision, self._kind(media))] += media.size or 0
+
+    def report(self) -> None:
+        for (decision, kind), size in sorted(
+            self.bytes.items(), key=lambda item: (item[0][0].value, item[0][1])
+        ):
+            logger.info(
+                f"Media policy: {decision.name.lower()} {size / 1024 ** 2:.1f}MB "
+                f"of {kind}"
+            )
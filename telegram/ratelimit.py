@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket for one class of Telegram requests. The rate slowly grows
+    while Telegram accepts requests, and is halved whenever we are told to
+    wait, in which case no request goes through until the wait is over.
+    """
+
+    def __init__(self, name: str, delay: float, burst: float = 1.0) -> None:
+        self.name = name
+
+        # Requests per second, starting from the given delay between requests
+        self.rate = 1 / delay
+        self.min_rate = self.rate / 4
+        self.max_rate = self.rate * 4
+        self.burst = burst
+
+        # Statistics reported when the client disconnects
+        self.requests = 0
+        self.flood_waits = 0
+        self.waited = 0.0
+
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._resume_at = 0.0
+        self._lock = asyncio.Lock()
+
+        # Requests waiting in acquire
+        self._waiting = 0
+
+    async def acquire(self) -> None:
+        """
+        Wait until a request can be sent.
+        """
+
+        self._waiting += 1
+        try:
+            await self._acquire()
+        finally:
+            self._waiting -= 1
+
+    async def _acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._tokens + (now - self._updated) * self.rate, self.burst
+                )
+                self._updated = now
+
+                delay = max(self._resume_at - now, (1 - self._tokens) / self.rate, 0)
+                if delay == 0:
+                    break
+
+                self.waited += delay
+                await asyncio.sleep(delay)
+
+            self._tokens -= 1
+            self.requests += 1
+
+    def expected_wait(self) -> float:
+        """
+        Estimate the seconds a new request would wait, counting the ones
+        already waiting ahead of it.
+        """
+
+        now = time.monotonic()
+        tokens = min(self._tokens + (now - self._updated) * self.rate, self.burst)
+
+        return max(self._resume_at - now, (1 + self._waiting - tokens) / self.rate, 0)
+
+    def success(self) -> None:
+        """
+        Telegram accepted a request, so try going a bit faster.
+        """
+
+        self.rate = min(self.rate + self.min_rate / 10, self.max_rate)
+
+    def flood_wait(self, seconds: int) -> None:
+        """
+        Telegram asked us to wait, so hold every request for exactly the
+        given amount of seconds and slow down.
+        """
+
+        self.flood_waits += 1
+        self.rate = max(self.rate / 2, self.min_rate)
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated = time.monotonic()
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name}: {self.requests} requests, {self.flood_waits} flood waits, "
+            f"{self.waited:.1f}s waiting, {self.rate:.2f} requests/s"
+        )
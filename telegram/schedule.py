@@ -0,0 +1,49 @@
+from typing import Optional, Tuple
+
+DAY = 24 * 3600
+
+
+class PollSchedule:
+    """
+    Decide how long to wait before polling a channel for new messages again,
+    from how many messages it got lately. Busy channels are polled every
+    min_interval seconds, quiet ones less and less often, up to max_interval
+    seconds. Channels without messages for inactive_after seconds are marked
+    inactive and polled every inactive_interval seconds.
+    """
+
+    def __init__(self, options: Optional[dict] = None) -> None:
+        options = options or {}
+
+        # Seconds of history the message rate is measured over
+        self.window: float = options.get("window", 30 * DAY)
+
+        # New messages a poll should find, at the measured rate
+        self.target_messages: int = options.get("target_messages", 50)
+
+        self.min_interval: float = options.get("min_interval", 15 * 60)
+        self.max_interval: float = options.get("max_interval", 7 * DAY)
+        self.inactive_after: float = options.get("inactive_after", 90 * DAY)
+        self.inactive_interval: float = options.get("inactive_interval", 30 * DAY)
+
+    def plan(
+        self, recent: int, idle: Optional[float], age: Optional[float]
+    ) -> Tuple[float, float, bool]:
+        """
+        Get the rate of messages (per day), the seconds until the next poll and
+        whether the channel is still active, from the number of messages over
+        the window and the seconds since the latest and the oldest of the
+        messages looked at, if any.
+        """
+
+        # Channels younger than the window (or too busy for all of their
+        # messages in the window to be counted) are measured over less time
+        span = min(self.window, max(age or 0, DAY))
+        rate = recent / span
+        if idle is None or idle >= self.inactive_after:
+            return rate * DAY, self.inactive_interval, False
+
+        interval = self.target_messages / rate if rate > 0 else self.max_interval
+        interval = min(max(interval, self.min_interval), self.max_interval)
+
+        return rate * DAY, interval, True
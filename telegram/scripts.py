@@ -5,6 +5,7 @@ import pandas as pd
 
 from .common import config, logger
 from .database import Database
+from .storage import DOWNLOAD_FOLDER, STORE_FOLDER, media_path
 from .utils import backup_postgres_db, compress_file
 
 
@@ -83,3 +84,70 @@ def export(args) -> None:
         if os.path.isfile(args.dest_file):
             logger.info("Removing uncompressed file")
             os.remove(args.dest_file)
+
+
+def migrate_downloads(args, db: Database) -> None:
+    """
+    Move the media of folders named after dialog titles to the folders keyed
+    by channel id, and record where each file went. Folders whose title isn't
+    known are left in place.
+    """
+
+    titles = db.get_channel_titles()
+    channel_ids = {str(channel_id) for channel_id in titles.values()}
+    moved = duplicates = 0
+
+    for root, folders, files in os.walk(DOWNLOAD_FOLDER):
+        if root == DOWNLOAD_FOLDER:
+            # Leave out the store and the dialogs already migrated
+            folders[:] = [
+                folder
+                for folder in folders
+                if os.path.join(root, folder) != STORE_FOLDER
+                and folder not in channel_ids
+            ]
+            continue
+
+        message_ids = [int(name) for name in files if name.isdigit()]
+        if not message_ids:
+            continue
+
+        # Titles with slashes were dumped into nested folders
+        title = os.path.relpath(root, DOWNLOAD_FOLDER)
+        channel_id = titles.get(title)
+        if channel_id is None:
+            logger.warning(f"No dialog titled {title}, leaving {root} as it is")
+            continue
+
+        verb = "Would move" if args.dry_run else "Moving"
+        logger.info(f"{verb} {len(message_ids)} files of {title} ({channel_id})")
+        paths = {}
+        for message_id in message_ids:
+            source = os.path.join(root, str(message_id))
+            local_path = media_path(channel_id, message_id)
+            destination = os.path.join(DOWNLOAD_FOLDER, local_path)
+            paths[message_id] = local_path
+
+            if args.dry_run:
+                continue
+
+            if os.path.lexists(destination):
+                # Also in the folder of another title of the same dialog
+                os.remove(source)
+                duplicates += 1
+            else:
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                os.replace(source, destination)
+                moved += 1
+
+        if not args.dry_run:
+            db.set_media_paths(channel_id, paths)
+            db.commit_changes()
+
+            # Remove the folders left empty, up to the downloads folder
+            folder = root
+            while folder != DOWNLOAD_FOLDER and not os.listdir(folder):
+                os.rmdir(folder)
+                folder = os.path.dirname(folder)
+
+    logger.info(f"Moved {moved} files, removed {duplicates} duplicates")
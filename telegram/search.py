@@ -1,7 +1,5 @@
-import asyncio
 import os
 import re
-import time
 from datetime import datetime, timedelta, timezone
 from enum import Enum
 from typing import List
@@ -10,8 +8,8 @@ from tqdm import tqdm
 from twarc.client2 import Twarc2
 
 from .client import TelegramClient
-from .common import CHAT_DELAY, config, logger
-from .database import Database
+from .common import config, logger
+from .database import AsyncDatabase
 
 
 class TelegramLink(Enum):
@@ -24,7 +22,7 @@ class TelegramLink(Enum):
 
 
 class Searcher:
-    def __init__(self, args, client: TelegramClient, db: Database):
+    def __init__(self, args, client: TelegramClient, db: AsyncDatabase):
         self.tl_client = client
 
         if args.search_twitter:
@@ -91,9 +89,17 @@ class Searcher:
 
     async def _join_invite_links(self, invite_links: List[str]) -> None:
         logger.info("Joining invite links")
-        for link in tqdm(invite_links):
-            start = time.time()
 
+        # Get the entities of already resolved usernames in batches
+        await self.tl_client.resolve_public_links(
+            [
+                link
+                for link in invite_links
+                if self._match_link(link) == TelegramLink.PUBLIC
+            ]
+        )
+
+        for link in tqdm(invite_links):
             match self._match_link(link):
                 case TelegramLink.PRIVATE:
                     await self.tl_client.join_private_channel(link)
@@ -103,9 +109,6 @@ class Searcher:
                     logger.error(f"Uncaught link pattern when joining: {link}")
                     pass
 
-            delay = max(CHAT_DELAY - (time.time() - start), 0)
-            await asyncio.sleep(delay)
-
     async def _filter_invite_links(self, invite_links: List[str]) -> List[str]:
         urls = set()
         final_urls = set()
@@ -139,10 +142,13 @@ class Searcher:
                 case _:
                     pass
 
+        # Get the entities of already resolved usernames in batches
+        await self.tl_client.resolve_public_links(
+            [link for link in urls if self._match_link(link) == TelegramLink.PUBLIC]
+        )
+
         # For a smaller list, use Telegram's API to check if we should join
         for link in tqdm(urls):
-            start = time.time()
-
             match self._match_link(link):
                 case TelegramLink.PRIVATE:
                     if await self.tl_client.check_private_link(link=link):
@@ -154,9 +160,6 @@ class Searcher:
                     logger.warning(f"Uncaught link not transformed: {link}")
                     pass
 
-            delay = max(CHAT_DELAY - (time.time() - start), 0)
-            await asyncio.sleep(delay)
-
         return list(final_urls)
 
     async def _get_twitter_invite_links(self) -> List[str]:
@@ -199,7 +202,7 @@ class Searcher:
 
         logger.info("Getting invite links from database")
 
-        messages = self.db.get_messages_with_pattern(pattern="%t.me%")
+        messages = await self.db.get_messages_with_pattern(pattern="%t.me%")
         for message in messages:
             # Join group returns from re.findall
             urls_to_add = ["".join(url) for url in self.base_pattern.findall(message)]
@@ -0,0 +1,101 @@
+"""
+Conversion of Telethon's TL objects into JSON-native values, stored in the
+data columns of the database.
+
+TLObject.to_json builds a dict of the whole object, turns it into a string
+with a fallback hook for bytes and datetimes, and the string is then parsed
+again by PostgreSQL. Here, objects are walked once straight into JSON-native
+values, fields left empty are dropped, and the top-level fields kept can be
+restricted with the message_fields setting.
+"""
+import base64
+import hashlib
+import json
+from datetime import datetime
+from types import ModuleType
+from typing import Any, Collection, Dict, List, Optional, Tuple
+
+from telethon.tl.tlobject import TLObject
+
+from .common import config
+
+orjson: Optional[ModuleType]
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Top-level fields of messages kept in messages.data, or all of them if unset
+MESSAGE_FIELDS: Optional[List[str]] = config.get("message_fields")
+
+# Constructor name and fields of each TL class, as listed by its to_dict
+_FIELDS: Dict[type, Tuple[str, List[str]]] = {}
+
+
+def _fields(obj: TLObject) -> Tuple[str, List[str]]:
+    cls = type(obj)
+    if cls not in _FIELDS:
+        keys = obj.to_dict()
+        _FIELDS[cls] = (keys["_"], [key for key in keys if key != "_"])
+
+    return _FIELDS[cls]
+
+
+def to_native(value: Any, fields: Optional[List[str]] = None) -> Any:
+    """
+    Convert a TL object (or a list of them) into dicts, lists and scalars that
+    JSON can represent. Bytes are base64 encoded and datetimes ISO formatted,
+    like TLObject.to_json does. Only the given fields of a top-level object
+    are kept.
+    """
+
+    if isinstance(value, TLObject):
+        name, keys = _fields(value)
+        native = {"_": name}
+        for key in keys if fields is None else fields:
+            field = getattr(value, key, None)
+            if field is not None:
+                native[key] = to_native(field)
+        return native
+    elif isinstance(value, (list, tuple)):
+        return [to_native(item) for item in value]
+    elif isinstance(value, datetime):
+        return value.isoformat()
+    elif isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+
+    return value
+
+
+def dumps(value: Any) -> str:
+    """
+    Serialize a JSON-native value, with orjson when it is installed.
+    """
+
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode()
+        except TypeError:
+            # Integers out of 64 bits, for instance
+            pass
+
+    return json.dumps(value)
+
+
+def content_hash(value: Any, ignore: Collection[str] = ()) -> str:
+    """
+    Hash a JSON-native value, leaving out the fields named in ignore at any
+    depth. Keys are sorted, so that equal values hash the same.
+    """
+
+    def strip(value: Any) -> Any:
+        if isinstance(value, dict):
+            return {
+                key: strip(field) for key, field in value.items() if key not in ignore
+            }
+        elif isinstance(value, list):
+            return [strip(item) for item in value]
+        return value
+
+    text = json.dumps(strip(value), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode()).hexdigest()
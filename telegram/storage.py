@@ -0,0 +1,209 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+DOWNLOAD_FOLDER = "downloads"
+STORE_FOLDER = os.path.join(DOWNLOAD_FOLDER, ".store")
+
+
+def fan_out(key: int) -> str:
+    """
+    Name of the subfolder of a file keyed by an id, so that no folder gets too
+    big.
+    """
+
+    return f"{key % 256:02x}"
+
+
+def media_path(channel_id: int, message_id: int) -> str:
+    """
+    Path of the media of a message, relative to the downloads folder. Dialogs
+    are kept by id, so that renaming one doesn't start a new folder.
+    """
+
+    return os.path.join(str(channel_id), fan_out(message_id), str(message_id))
+
+
+# Telegram numbers photos and documents apart, so stored media is keyed by
+# both its kind and its id
+MediaKey = Tuple[str, int]
+
+
+def media_key(media_id: int, is_document: bool) -> MediaKey:
+    return ("documents" if is_document else "photos", media_id)
+
+
+class MediaStore:
+    """
+    Content-addressed store of downloaded media. Files are kept once, keyed by
+    their kind and Telegram media id, and dialogs only hold links to them, so
+    media forwarded to several dialogs is downloaded a single time.
+    """
+
+    def __init__(self, root: str = STORE_FOLDER) -> None:
+        self.root = root
+
+        # Downloads in progress, so that concurrent requests wait for them
+        self._downloads: Dict[MediaKey, asyncio.Event] = {}
+
+    def path(self, key: MediaKey) -> str:
+        kind, media_id = key
+        return os.path.join(self.root, kind, fan_out(media_id), str(media_id))
+
+    def has(self, key: MediaKey) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def index(self) -> Set[MediaKey]:
+        """
+        List the keys of every stored media, one folder listing at a time.
+        """
+
+        keys: Set[MediaKey] = set()
+        for kind in ["photos", "documents"]:
+            root = os.path.join(self.root, kind)
+            if not os.path.isdir(root):
+                continue
+
+            for folder in os.scandir(root):
+                if not folder.is_dir():
+                    continue
+
+                for entry in os.scandir(folder.path):
+                    if entry.name.isdigit():
+                        keys.add((kind, int(entry.name)))
+
+        return keys
+
+    def link(self, key: MediaKey, filename: str) -> None:
+        """
+        Make a stored media available at the given filename.
+        """
+
+        if os.path.lexists(filename):
+            return
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        try:
+            os.link(self.path(key), filename)
+        except OSError:
+            # Hard links don't work across file systems
+            os.symlink(os.path.abspath(self.path(key)), filename)
+
+    async def fetch(
+        self,
+        key: MediaKey,
+        filename: str,
+        download: Callable[[str], Awaitable[None]],
+    ) -> None:
+        """
+        Make a media available at the given filename, calling download with a
+        temporary path only if the media is not stored yet.
+        """
+
+        while not self.has(key):
+            if key in self._downloads:
+                # Someone else is downloading it, check again when they're done
+                await self._downloads[key].wait()
+            else:
+                await self._download(key, download)
+
+        self.link(key, filename)
+
+    async def _download(
+        self, key: MediaKey, download: Callable[[str], Awaitable[None]]
+    ) -> None:
+        path = self.path(key)
+        partial = f"{path}.part"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._downloads[key] = asyncio.Event()
+        try:
+            # Only complete files are moved into the store
+            await download(partial)
+            os.replace(partial, path)
+        finally:
+            # Downloads in parts resume from what they left
+            if os.path.isfile(partial) and not PartialFile.resumable(partial):
+                os.remove(partial)
+
+            self._downloads.pop(key).set()
+
+
+class PartialFile:
+    """
+    A file downloaded in parts of part_size bytes, which may be done in any
+    order. Done parts are appended to a progress sidecar, so that an
+    interrupted download resumes with the parts still missing.
+    """
+
+    def __init__(self, path: str, size: int, part_size: int) -> None:
+        self.path = path
+        self.size = size
+        self.part_size = part_size
+        self.count = (size + part_size - 1) // part_size
+
+        self.done = self._load() if os.path.isfile(path) else set()
+        self._missing = iter(
+            [index for index in range(self.count) if index not in self.done]
+        )
+
+        if not os.path.isfile(path):
+            open(path, "wb").close()
+        os.truncate(path, size)
+
+        self._file = os.open(path, os.O_WRONLY)
+        self._progress = open(self.progress_path(path), "a")
+        if not self.done:
+            self._progress.truncate(0)
+            self._progress.write(f"{size} {part_size}\n")
+            self._progress.flush()
+
+    @staticmethod
+    def progress_path(path: str) -> str:
+        return f"{path}.progress"
+
+    @staticmethod
+    def resumable(path: str) -> bool:
+        return os.path.isfile(PartialFile.progress_path(path))
+
+    def _load(self) -> Set[int]:
+        """
+        Read the parts done by a previous download of the same file.
+        """
+
+        try:
+            with open(self.progress_path(self.path)) as f:
+                header, *lines = f.read().split("\n")
+        except FileNotFoundError:
+            return set()
+
+        if header != f"{self.size} {self.part_size}":
+            return set()
+
+        # The last line may have been cut short
+        return {int(line) for line in lines if line.isdigit()}
+
+    @property
+    def missing(self) -> int:
+        return self.count - len(self.done)
+
+    def next_part(self) -> Optional[int]:
+        """
+        Claim the next missing part, or None if all of them are claimed.
+        """
+
+        return next(self._missing, None)
+
+    def write(self, index: int, data: bytes) -> None:
+        os.pwrite(self._file, data, index * self.part_size)
+
+        self.done.add(index)
+        self._progress.write(f"{index}\n")
+        self._progress.flush()
+
+    def close(self) -> None:
+        os.close(self._file)
+        self._progress.close()
+
+        if not self.missing:
+            os.remove(self.progress_path(self.path))
@@ -5,6 +5,7 @@ from typing import List
 from telethon.tl import types
 
 from .common import logger
+from .models import Channel
 
 
 def print_dialogs(dialogs: List[types.Dialog]) -> None:
@@ -12,6 +13,26 @@ def print_dialogs(dialogs: List[types.Dialog]) -> None:
         print(f"[{i+1}] {dialog.title} (id={dialog.id})")
 
 
+def print_schedule(channels: List[Channel]) -> None:
+    for channel in channels:
+        rate = "?"
+        if channel.message_rate is not None:
+            rate = f"{channel.message_rate:.1f}"
+        next_poll = channel.next_poll_utc or "now"
+
+        flags = []
+        if not channel.is_active:
+            flags.append("inactive")
+        if not channel.is_complete:
+            flags.append("incomplete")
+        flags_text = f" [{', '.join(flags)}]" if flags else ""
+
+        print(
+            f"{channel.name} (id={channel.channel_id}): {rate} messages/day, "
+            f"next poll {next_poll}{flags_text}"
+        )
+
+
 def backup_postgres_db(
     host: str, name: str, port: int, user: str, password: str, dest_file: str
 ):
@@ -0,0 +1,295 @@
+"""
+Fixtures shared by the tests.
+
+telegram.common reads config/config.yaml from the working directory when it is
+imported, so the tests run from a scratch folder holding the example
+configuration. The database is replaced by an in-memory fake.
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import types as pytypes
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_folder = tempfile.mkdtemp()
+os.makedirs(os.path.join(_folder, "config"))
+shutil.copy(
+    os.path.join(ROOT, "config", "config.yaml.example"),
+    os.path.join(_folder, "config", "config.yaml"),
+)
+os.chdir(_folder)
+
+from telethon.tl import types  # noqa: E402
+
+from telegram.database import AsyncDatabase  # noqa: E402
+from telegram.download import Downloader  # noqa: E402
+from telegram.models import Channel  # noqa: E402
+
+CHANNEL_ID = -1000000000001
+
+
+def make_message(message_id: int, edited: bool = False) -> types.Message:
+    """
+    A channel message with a photo.
+    """
+
+    date = datetime.now(timezone.utc)
+    photo = types.Photo(
+        id=message_id,
+        access_hash=message_id,
+        file_reference=b"\x00" * 16,
+        date=date,
+        sizes=[types.PhotoSize(type="x", w=800, h=600, size=1024)],
+        dc_id=1,
+    )
+    return types.Message(
+        id=message_id,
+        peer_id=types.PeerChannel(channel_id=1),
+        date=date,
+        message=f"Message {message_id}",
+        media=types.MessageMediaPhoto(photo=photo),
+        edit_date=date if edited else None,
+    )
+
+
+class FakeDatabase(AsyncDatabase):
+    """
+    Keeps the rows the downloader writes in dicts. Like Postgres, a statement
+    that fails aborts the transaction of its session: every later call fails
+    until the session is released.
+    """
+
+    def __init__(self) -> None:
+        self.channels: Dict[Optional[int], Channel] = {}
+        self.messages: Dict[Tuple[int, int], Any] = {}
+        self.media: Dict[Tuple[int, int], Any] = {}
+        self.jobs: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        self.backfill: Dict[Tuple[int, int], List[int]] = {}
+
+        # Owners of the leases by kind and key, which never expire
+        self.leases: Dict[Tuple[str, int], Optional[str]] = {}
+
+        # Methods called, with their task and arguments
+        self.calls: List[Tuple[str, Optional[asyncio.Task], tuple]] = []
+
+        # Methods whose next call fails
+        self.fail_next: Set[str] = set()
+        self.aborted = False
+
+    async def _run(self, method: str, *args) -> Any:
+        self.calls.append((method, asyncio.current_task(), args))
+        if self.aborted:
+            raise RuntimeError("current transaction is aborted")
+        if method in self.fail_next:
+            self.fail_next.discard(method)
+            self.aborted = True
+            raise RuntimeError(f"{method} failed")
+
+        return getattr(self, f"_{method}")(*args)
+
+    async def release(self) -> None:
+        self.aborted = False
+
+    def _commit_changes(self) -> None:
+        pass
+
+    def _flush_changes(self) -> None:
+        pass
+
+    def _upsert_channel(self, channel: Channel) -> None:
+        if channel.channel_id in self.channels:
+            stored = self.channels[channel.channel_id]
+            stored.max_message_id = max(stored.max_message_id, channel.max_message_id)
+        else:
+            channel.media_checkpoint_id = 0
+            self.channels[channel.channel_id] = channel
+
+    def _get_channel_by_id(self, channel_id: int) -> Optional[Channel]:
+        return self.channels.get(channel_id)
+
+    def _get_max_message_id(self, channel_id: int) -> Optional[int]:
+        channel = self.channels.get(channel_id)
+        return channel.max_message_id if channel else None
+
+    def _insert_messages(self, messages: list) -> None:
+        for message in messages:
+            self.messages[(message.channel_id, message.message_id)] = message
+
+    def _insert_media(self, media: list) -> None:
+        for record in media:
+            record.local_path = None
+            self.media.setdefault((record.channel_id, record.message_id), record)
+
+    def _get_media_after(self, channel_id: int, message_id: int, limit: int) -> List:
+        return sorted(
+            (
+                record
+                for (channel, message), record in self.media.items()
+                if channel == channel_id and message > message_id
+            ),
+            key=lambda record: record.message_id,
+        )[:limit]
+
+    def _update_media_checkpoint(self, channel_id: int, message_id: int) -> None:
+        self.channels[channel_id].media_checkpoint_id = message_id
+
+    def _set_media_paths(self, channel_id: int, paths: Dict[int, str]) -> None:
+        for message_id, path in paths.items():
+            self.media[(channel_id, message_id)].local_path = path
+
+    def _get_channel_activity(
+        self, channel_id: int, window: float
+    ) -> Tuple[int, Optional[float], Optional[float]]:
+        return (0, None, None)
+
+    def _schedule_channel(self, channel_id: int, *args) -> None:
+        pass
+
+    def _insert_backfill_ranges(self, ranges: list) -> None:
+        for backfill in ranges:
+            self.backfill[(backfill.channel_id, backfill.start_id)] = [
+                backfill.checkpoint_id,
+                backfill.end_id,
+            ]
+
+    def _get_backfill_ranges(self, channel_id: int) -> List[Tuple[int, int, int]]:
+        return sorted(
+            (start_id, checkpoint_id, end_id)
+            for (channel, start_id), (checkpoint_id, end_id) in self.backfill.items()
+            if channel == channel_id
+        )
+
+    def _insert_media_jobs(self, jobs: list) -> None:
+        for job in jobs:
+            self.jobs.setdefault(
+                (job.channel_id, job.message_id), dict(state="pending", attempts=0)
+            )
+
+    def _claim_media_jobs(self, channel_id: int) -> List[int]:
+        # Failed jobs are always due, as if the retry delay was over
+        claimed = []
+        for (channel, message_id), job in self.jobs.items():
+            if channel == channel_id and job["state"] in ["pending", "failed"]:
+                job["state"] = "pending"
+                claimed.append(message_id)
+
+        return sorted(claimed)
+
+    def _complete_media_jobs(self, channel_id: int, message_ids: List[int]) -> None:
+        for message_id in message_ids:
+            self.jobs.pop((channel_id, message_id), None)
+
+    def _fail_media_jobs(
+        self,
+        channel_id: int,
+        failures: List[Tuple[int, str]],
+        max_attempts: int,
+        retry_delay: float,
+    ) -> None:
+        for message_id, error in failures:
+            job = self.jobs.get((channel_id, message_id))
+            if job is None:
+                continue
+
+            job["attempts"] += 1
+            job["state"] = "dead" if job["attempts"] >= max_attempts else "failed"
+            job["last_error"] = error
+
+    def _get_time(self) -> datetime:
+        return datetime.now()
+
+    def _insert_leases(self, kind: str, keys: List[int]) -> None:
+        for key in keys:
+            self.leases.setdefault((kind, key), None)
+
+    def _claim_lease(
+        self, kind: str, keys: List[int], owner: str, since: datetime, ttl: float
+    ) -> Optional[int]:
+        for key in keys:
+            if self.leases.get((kind, key), owner) is None:
+                self.leases[(kind, key)] = owner
+                return key
+
+        return None
+
+    def _renew_leases(self, owner: str, ttl: float) -> None:
+        pass
+
+    def _finish_lease(self, kind: str, key: int, owner: str) -> None:
+        if self.leases.get((kind, key)) == owner:
+            self.leases[(kind, key)] = None
+
+    def _free_leases(self, kind: str, owner: str) -> None:
+        for lease, holder in self.leases.items():
+            if lease[0] == kind and holder == owner:
+                self.leases[lease] = None
+
+
+class FakeClient:
+    """
+    Serves the given messages, and fails to download the media of the
+    messages in failing.
+    """
+
+    def __init__(self, messages: List[types.Message]) -> None:
+        self.messages = {message.id: message for message in messages}
+        self.failing: Set[int] = set()
+
+    async def fetch_messages(
+        self, dialog, limit: int, min_id: int, max_id: Optional[int] = None
+    ) -> list:
+        return [
+            message
+            for message_id, message in sorted(self.messages.items(), reverse=True)
+            if message_id > min_id and (max_id is None or message_id < max_id)
+        ][:limit]
+
+    async def fetch_messages_by_ids(self, dialog, ids: List[int]) -> list:
+        return [self.messages.get(message_id) for message_id in ids]
+
+    async def get_media(self, media, filename: str, callback=None) -> None:
+        if media.message_id in self.failing:
+            raise ConnectionError("Connection lost")
+
+        with open(filename, "w") as f:
+            f.write(str(media.media_id))
+
+
+@pytest.fixture(autouse=True)
+def scratch_folder(tmp_path, monkeypatch):
+    # Downloaded media goes to the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture
+def dialog():
+    return pytypes.SimpleNamespace(
+        id=CHANNEL_ID, title="test", name="test", is_channel=True, message=None
+    )
+
+
+@pytest.fixture
+def db(dialog):
+    database = FakeDatabase()
+    database._upsert_channel(Channel(channel_id=dialog.id, name=dialog.name))
+
+    return database
+
+
+def make_downloader(client, db: FakeDatabase) -> Downloader:
+    args = pytypes.SimpleNamespace(
+        without_media=False,
+        concurrency=1,
+        media_workers=2,
+        backfill_ranges=1,
+        ignore_schedule=True,
+    )
+    return Downloader(args, client, db)
@@ -0,0 +1,133 @@
+import asyncio
+
+from conftest import FakeClient, make_downloader, make_message
+
+from telegram.models import BackfillRange, Channel, Media, MediaJob
+
+
+def test_past_media_that_failed_is_tried_again(db, dialog):
+    messages = [make_message(message_id) for message_id in range(1, 5)]
+    db._insert_media([Media(message, channel_id=dialog.id) for message in messages])
+
+    client = FakeClient(messages)
+    client.failing = {2}
+    downloader = make_downloader(client, db)
+
+    asyncio.run(downloader.download_past_media(dialog))
+
+    # The checkpoint moves past the failed media, which keeps a job
+    assert db.channels[dialog.id].media_checkpoint_id == 4
+    assert list(db.jobs) == [(dialog.id, 2)]
+    assert db.jobs[(dialog.id, 2)]["state"] == "failed"
+    assert db.media[(dialog.id, 2)].local_path is None
+
+    client.failing = set()
+    asyncio.run(downloader.download_past_media(dialog))
+
+    assert db.jobs == {}
+    assert all(record.local_path is not None for record in db.media.values())
+
+
+def test_unfinished_backfill_is_pending(db, dialog):
+    # The messages after the range were fetched, the ones in it weren't
+    dialog.message = make_message(1000)
+    db._upsert_channel(Channel(dialog.id, dialog.name, max_message_id=1000))
+    db._insert_backfill_ranges([BackfillRange(dialog.id, 0, 500)])
+
+    downloader = make_downloader(FakeClient([]), db)
+    pending = asyncio.run(downloader._init_channels([dialog]))
+
+    assert pending == {dialog.id: 500}
+
+
+def test_live_messages_are_written_after_a_failed_write(db, dialog):
+    downloader = make_downloader(FakeClient([]), db)
+    downloader.with_media = False
+    downloader._followed = {dialog.id: dialog}
+
+    async def write():
+        db.fail_next = {"insert_messages"}
+        await downloader._write_live_batch([(make_message(1), False)])
+        await downloader._write_live_batch([(make_message(2), False)])
+
+    asyncio.run(write())
+
+    assert list(db.messages) == [(dialog.id, 2)]
+
+
+def test_media_jobs_are_written_with_their_messages(db, dialog):
+    messages = [make_message(message_id) for message_id in range(1, 4)]
+    dialog.message = messages[-1]
+    downloader = make_downloader(FakeClient(messages), db)
+
+    asyncio.run(downloader.start(dialog))
+
+    # The jobs are committed by the task that writes their messages, in the
+    # same transaction
+    _, task, (jobs,) = next(call for call in db.calls if call[0] == "insert_media_jobs")
+    calls = [method for method, caller, _ in db.calls if caller is task]
+    start, end = calls.index("insert_messages"), calls.index("insert_media_jobs")
+
+    assert "commit_changes" not in calls[start:end]
+    assert sorted((job.channel_id, job.message_id) for job in jobs) == [
+        (dialog.id, message_id) for message_id in range(1, 4)
+    ]
+    assert db.jobs == {}
+
+
+def test_failed_media_over_the_defer_size_keeps_its_job(db, dialog):
+    message = make_message(2)
+    dialog.message = message
+    db._upsert_channel(Channel(dialog.id, dialog.name, max_message_id=2))
+    db._insert_media_jobs([MediaJob(dialog.id, 2)])
+    db.jobs[(dialog.id, 2)].update(state="failed", attempts=1)
+
+    client = FakeClient([message])
+    client.failing = {2}
+    downloader = make_downloader(client, db)
+    downloader.policy.defer_size = 512
+
+    asyncio.run(downloader.start(dialog))
+
+    # Tried again rather than deferred, since the checkpoint is past it
+    assert db.jobs[(dialog.id, 2)]["state"] == "failed"
+    assert db.jobs[(dialog.id, 2)]["attempts"] == 2
+
+
+def test_media_jobs_wait_for_the_worker_leasing_them(db, dialog):
+    message = make_message(1)
+    db._insert_media([Media(message, channel_id=dialog.id)])
+    db._insert_media_jobs([MediaJob(dialog.id, 1)])
+    db.leases[("media", dialog.id)] = "other"
+
+    downloader = make_downloader(FakeClient([message]), db)
+    downloader.lease_ttl = 0.03
+
+    async def download():
+        task = asyncio.ensure_future(downloader.download_past_media(dialog))
+        await asyncio.sleep(0.1)
+        claimed = any(call[0] == "claim_media_jobs" for call in db.calls)
+
+        db._finish_lease("media", dialog.id, "other")
+        await task
+
+        return claimed
+
+    assert not asyncio.run(download())
+    assert db.jobs == {}
+    assert db.leases[("media", dialog.id)] is None
+
+
+def test_heartbeat_outlives_a_failed_renewal(db):
+    downloader = make_downloader(FakeClient([]), db)
+    downloader.lease_ttl = 0.03
+    db.fail_next = {"renew_leases"}
+
+    async def beat():
+        heartbeat = asyncio.ensure_future(downloader._heartbeat())
+        await asyncio.sleep(0.1)
+        heartbeat.cancel()
+
+    asyncio.run(beat())
+
+    assert [call[0] for call in db.calls].count("renew_leases") > 1
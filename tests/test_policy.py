@@ -0,0 +1,56 @@
+from datetime import datetime, timezone
+
+from conftest import CHANNEL_ID, make_message
+from telethon.tl import types
+
+from telegram.models import Media
+from telegram.policy import MediaDecision, MediaPolicy
+
+
+def make_video(message_id: int, size: int) -> types.Message:
+    """
+    A channel message with a video document, which has a file name too.
+    """
+
+    date = datetime.now(timezone.utc)
+    document = types.Document(
+        id=message_id,
+        access_hash=message_id,
+        file_reference=b"\x00" * 16,
+        date=date,
+        mime_type="video/mp4",
+        size=size,
+        dc_id=1,
+        attributes=[
+            types.DocumentAttributeVideo(duration=1, w=640, h=480),
+            types.DocumentAttributeFilename(file_name="video.mp4"),
+        ],
+    )
+    return types.Message(
+        id=message_id,
+        peer_id=types.PeerChannel(channel_id=1),
+        date=date,
+        message=f"Message {message_id}",
+        media=types.MessageMediaDocument(document=document),
+    )
+
+
+def test_media_of_several_kinds_goes_by_the_most_specific():
+    media = Media(make_video(1, 2048), channel_id=CHANNEL_ID)
+    policy = MediaPolicy({"priorities": {"video": 7, "document": 1}})
+
+    decision, priority = policy.decide(media)
+    policy.count(decision, media)
+
+    assert (decision, priority) == (MediaDecision.DOWNLOAD, 7)
+    assert dict(policy.bytes) == {(MediaDecision.DOWNLOAD, "video"): 2048}
+
+
+def test_priorities_given_override_the_defaults():
+    policy = MediaPolicy({"priorities": {"video": None}})
+
+    photo = Media(make_message(1), channel_id=CHANNEL_ID)
+    video = Media(make_video(2, 2048), channel_id=CHANNEL_ID)
+
+    assert policy.decide(photo) == (MediaDecision.DOWNLOAD, 0)
+    assert policy.decide(video) == (MediaDecision.SKIP, 0)